@@ -4,11 +4,14 @@ import bpy
 
 
 class BlenderRender:
-    def __init__(self, gpu, ortho_scale=256):
+    def __init__(self, gpu, ortho_scale=256, setup=True):
+        self.ortho_scale = ortho_scale
+        if not setup:
+            ## the scene was opened from a SceneTemplate
+            return
         if gpu:
             self.switchToGPU()
         self.delete(lambda x: x.name != 'Camera')
-        self.ortho_scale = ortho_scale
         self.setup_camera(ortho_scale=self.ortho_scale)
         self.create_sun(energy=0.5, size=0.1)
         bpy.data.worlds['World'].horizon_color = (0, 0, 0)
@@ -22,6 +25,32 @@ class BlenderRender:
         bpy.context.scene.render.filepath = os.path.join(path, name + '.' + extension)
         bpy.ops.render.render(write_still=True)
 
+    def capture(self):
+        """
+        Render without writing and return the composited frame as a (height, width, 4) float32 array
+        (linear, premultiplied, bottom row first). The Render Result image has no pixel buffer in python,
+        so this reads the compositor's Viewer node, which IntrinsicRender feeds with the Composite input.
+        """
+        bpy.ops.render.render()
+        viewer = bpy.data.images['Viewer Node']
+        width, height = viewer.size
+        return np.array(viewer.pixels[:], dtype=np.float32).reshape(height, width, 4)
+
+    def writeAnimation(self, path, name, indices, extension='png'):
+        """
+        Render the frames start, start + 1, ... of the scene range with a single render call and move the file
+        of frame start + i to path/<indices[i]>_<name>.<extension>, returns the new paths.
+        """
+        scene = bpy.context.scene
+        scene.render.filepath = os.path.join(path, '.' + name + '_')
+        bpy.ops.render.render(animation=True)
+        paths = []
+        for offset, index in enumerate(indices):
+            target = os.path.join(path, '{}_{}.{}'.format(index, name, extension))
+            os.replace(scene.render.frame_path(frame=scene.frame_start + offset), target)
+            paths.append(target)
+        return paths
+
     def switchToGPU(self, verbose=True):
         if verbose:
             print('before changing settings: ', bpy.context.scene.cycles.device)
@@ -130,6 +159,62 @@ class BlenderRender:
             for dim in range(3):
                 obj.rotation_euler[dim] = self.__toRadians(angles[dim])
 
+    def keyframes(self, datablock, path, values, start=1):
+        """
+        Animate path of datablock (object, lamp, node tree, ...) with one row of values per frame from start on.
+        The keys are written into the fcurves in one go instead of a keyframe_insert per frame and axis.
+        """
+        values = np.asarray(values, dtype=np.float32)
+        if values.ndim == 1:
+            values = values[:, None]
+        if datablock.animation_data is None:
+            datablock.animation_data_create()
+        if datablock.animation_data.action is None:
+            datablock.animation_data.action = bpy.data.actions.new(datablock.name + '_sweep')
+        action = datablock.animation_data.action
+        frames = np.arange(start, start + len(values), dtype=np.float32)
+        for dim in range(values.shape[1]):
+            fcurve = action.fcurves.find(path, dim)
+            if fcurve is not None:
+                action.fcurves.remove(fcurve)
+            fcurve = action.fcurves.new(path, index=dim)
+            fcurve.keyframe_points.add(len(values))
+            fcurve.keyframe_points.foreach_set('co', np.stack([frames, values[:, dim]], axis=1).ravel())
+            fcurve.update()
+
+    def clearKeyframes(self, datablocks):
+        for datablock in datablocks:
+            if datablock.animation_data is None:
+                continue
+            action = datablock.animation_data.action
+            datablock.animation_data_clear()
+            if action is not None and action.users == 0:
+                bpy.data.actions.remove(action)
+
+    def sunKeyframes(self, energies, sun_sizes, start=1):
+        sun = bpy.data.objects['Sun'].data
+        self.keyframes(sun, 'shadow_soft_size', sun_sizes, start)
+        self.keyframes(sun.node_tree, 'nodes["Emission"].inputs["Strength"].default_value', energies, start)
+
+    def sweep(self, camera_locs, sun_eulers, energies, sun_sizes, shape_eulers, shapes, start=1):
+        """
+        Keyframe a block of samples as the frames start, start + 1, ...: camera location, sun rotation, energy
+        and size, and the rotation of the shapes (angles in degrees, as translate / rotate / sun per sample).
+        Returns the animated datablocks for clearKeyframes.
+        """
+        shapes = self.__ensureList(shapes)
+        camera, sun = bpy.data.objects['Camera'], bpy.data.objects['Sun']
+        self.keyframes(camera, 'location', camera_locs, start)
+        self.keyframes(sun, 'rotation_euler', np.radians(sun_eulers), start)
+        self.sunKeyframes(energies, sun_sizes, start)
+        for name in shapes:
+            self.keyframes(bpy.data.objects[name], 'rotation_euler', np.radians(shape_eulers), start)
+        scene = bpy.context.scene
+        scene.frame_start = start
+        scene.frame_end = start + len(camera_locs) - 1
+        scene.frame_step = 1
+        return [camera, sun, sun.data, sun.data.node_tree] + [bpy.data.objects[name] for name in shapes]
+
     def delete(self, function):
         for obj in bpy.data.objects:
             if function(obj):
@@ -186,12 +271,32 @@ class BlenderRender:
             else:
                 obj.select = False
 
-    def duplicate(self, old, new):
+    def duplicate(self, old, new, linked=False):
+        if linked:
+            self.__linkedDuplicate(old, new)
+            return
         self.__select(lambda x: x.name == old)
         bpy.ops.object.duplicate()
         obj = bpy.data.objects[old + '.001']
         obj.name = new
 
+    def __linkedDuplicate(self, old, new):
+        """
+        New object using the same mesh datablock as old (no copy of the vertices). Its material slots are
+        linked to the object, so material overrides on the duplicate leave the shared mesh untouched.
+        """
+        src = bpy.data.objects[old]
+        obj = bpy.data.objects.new(new, src.data)
+        obj.name = new
+        obj.location = src.location
+        obj.rotation_euler = src.rotation_euler
+        obj.scale = src.scale
+        bpy.context.scene.objects.link(obj)
+        for slot in obj.material_slots:
+            material = slot.material
+            slot.link = 'OBJECT'
+            slot.material = material
+
     def sphere(self, location, scale, label='shape'):
         bpy.ops.mesh.primitive_uv_sphere_add(segments=200, ring_count=200, location=location, size=scale)
         bpy.data.objects['Sphere'].name = label
@@ -200,6 +305,10 @@ class BlenderRender:
         bpy.ops.object.material_slot_add()
         bpy.data.objects[label].data.materials[0] = bpy.data.materials['sphere']
 
+    def referenceSphere(self):
+        """ the sphere the lights mode renders, part of the scene setup (and of a SceneTemplate) """
+        self.sphere([0, 0, 0], 100, label='sphere')
+
     def spotlight(self, x, y, z, rot_x, rot_y, rot_z):
         spot = bpy.data.objects['Spot']
         spot.location = [x, y, z]
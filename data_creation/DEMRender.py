@@ -1,31 +1,44 @@
 import bpy
 import numpy as np
 import os
+import hashlib
+from data_creation import utils
 
 
 class DEMRender:
-    def __init__(self, dem_root_path, tex_root_path, max_load=-1):
-        if max_load > 0:
-            self.dem_paths = sorted([os.path.join(dem_root_path, dem_path) for dem_path in \
-                                     os.listdir(dem_root_path)[:max_load]])
-            self.tex_paths = sorted([os.path.join(tex_root_path, tex_path) for tex_path in \
-                                     os.listdir(tex_root_path)[:max_load]])
-        else:
-            self.dem_paths = sorted([os.path.join(dem_root_path, dem_path) for dem_path in os.listdir(dem_root_path)])
-            self.tex_paths = sorted([os.path.join(tex_root_path, tex_path) for tex_path in os.listdir(tex_root_path)])
+    def __init__(self, dem_root_path, tex_root_path, max_load=-1, cache_dir=None, lod_density=0, lod_error=0.1):
+        self.dem_paths, self.tex_paths = utils.dem_paths(dem_root_path, tex_root_path, max_load)
 
         self.dem_root_path = dem_root_path
         self.tex_root_path = tex_root_path
+        ## imported DEM meshes are kept as library .blend files here (None disables the cache)
+        self.cache_dir = cache_dir
+        if cache_dir is not None and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        ## level of detail: output pixels per world unit the DEM grid is resampled to (0 keeps every pixel) and the
+        ## largest height error (world units) the resampling may introduce
+        self.lod_density = lod_density
+        self.lod_error = lod_error
 
     def load(self, index):
+        cache_path = self.cachePath(index)
+        if cache_path is not None and os.path.exists(cache_path):
+            self.__append(cache_path, 'shape')
+            return
+
         bpy.ops.geoscene.clear_georef()
         self.get_DEM(self.dem_paths[index])
-        self.get_texture(self.tex_paths[index])
         names = [x.name for x in bpy.data.objects if self.dem_paths[index].split('/')[-1].split('.')[0] in x.name]
+        if self.lod_density > 0:
+            ## before the texture import, which projects its uvs onto the mesh as it is then
+            self.decimate(names[0], self.lod_density, self.lod_error)
+        self.get_texture(self.tex_paths[index])
 
         if len(names) > 1:
             print('names found more than one object named dsm')
         self.__rename(names[0], 'shape')
+        if cache_path is not None:
+            self.__save(cache_path, 'shape', self.tex_paths[index])
 
     def get_DEM(self, filepath):
         bpy.ops.importgis.georaster("EXEC_DEFAULT", filepath=filepath, importMode='DEM_RAW')
@@ -33,6 +46,107 @@ class DEMRender:
     def get_texture(self, filepath):
         bpy.ops.importgis.georaster("EXEC_DEFAULT", filepath=filepath, importMode='MESH')
 
+    def cachePath(self, index):
+        """ cache file of a DEM / texture pair, keyed by both paths and modification times """
+        if self.cache_dir is None:
+            return None
+        key = ''
+        for path in [self.dem_paths[index], self.tex_paths[index]]:
+            key += os.path.abspath(path) + ':' + str(os.path.getmtime(path)) + ';'
+        if self.lod_density > 0:
+            key += 'lod:{}:{}'.format(self.lod_density, self.lod_error)
+        name = os.path.basename(self.dem_paths[index]).split('.')[0]
+        return os.path.join(self.cache_dir, name + '_' + hashlib.md5(key.encode('utf-8')).hexdigest()[:12] + '.blend')
+
+    def decimate(self, name, density, max_error):
+        """
+        Resamples the DEM_RAW grid mesh of an object to about one vertex per output pixel (density: output pixels
+        per world unit), but never coarser than keeps the bilinear height error within max_error.
+        Meshes that are not a full regular grid (e.g. nodata holes) are left alone.
+        """
+        mesh = bpy.data.objects[name].data
+        co = np.empty(len(mesh.vertices) * 3, dtype=np.float64)
+        mesh.vertices.foreach_get('co', co)
+        co = co.reshape(-1, 3)
+        xs = np.unique(co[:, 0].round(6))
+        ys = np.unique(co[:, 1].round(6))
+        if len(xs) * len(ys) != len(co) or len(xs) < 2 or len(ys) < 2:
+            print('{} is not a regular grid, skipping lod'.format(name))
+            return
+        ## rows from north to south like the raster
+        grid = co[np.lexsort((co[:, 0], -co[:, 1]))].reshape(len(ys), len(xs), 3)
+        spacing = max(xs[1] - xs[0], ys[1] - ys[0])
+        stride = int(1. / (density * spacing))
+        while stride > 1 and self.__lodError(grid[:, :, 2], stride) > max_error:
+            stride -= 1
+        if stride <= 1:
+            return
+        rows, cols = self.__lodIndices(len(ys), stride), self.__lodIndices(len(xs), stride)
+        self.__setGrid(mesh, grid[rows][:, cols])
+        print('lod: {} from {}x{} to {}x{} vertices'.format(name, len(ys), len(xs), len(rows), len(cols)))
+
+    def __lodIndices(self, n, stride):
+        indices = np.arange(0, n, stride)
+        if indices[-1] != n - 1:
+            indices = np.append(indices, n - 1)
+        return indices
+
+    def __lodError(self, heights, stride):
+        """ largest difference between the heights and their bilinear reconstruction from every stride-th one """
+        rows = self.__lodIndices(heights.shape[0], stride)
+        cols = self.__lodIndices(heights.shape[1], stride)
+        coarse = heights[rows][:, cols]
+        for axis, kept in [(1, cols), (0, rows)]:
+            full = np.arange(heights.shape[axis])
+            left = np.clip(np.searchsorted(kept, full, 'right') - 1, 0, len(kept) - 2)
+            weight = (full - kept[left]) / (kept[left + 1] - kept[left]).astype(np.float64)
+            if axis == 1:
+                coarse = coarse[:, left] * (1 - weight) + coarse[:, left + 1] * weight
+            else:
+                coarse = coarse[left] * (1 - weight[:, None]) + coarse[left + 1] * weight[:, None]
+        return np.abs(coarse - heights).max()
+
+    def __setGrid(self, mesh, grid):
+        """ replaces the geometry of mesh with a quad grid through the (rows, cols, 3) vertices """
+        n_rows, n_cols = grid.shape[:2]
+        index = np.arange(n_rows * n_cols).reshape(n_rows, n_cols)
+        quads = np.stack([index[:-1, :-1], index[1:, :-1], index[1:, 1:], index[:-1, 1:]], axis=-1).reshape(-1, 4)
+        smooth = len(mesh.polygons) > 0 and mesh.polygons[0].use_smooth
+        new = bpy.data.meshes.new(mesh.name)
+        new.vertices.add(n_rows * n_cols)
+        new.vertices.foreach_set('co', grid.reshape(-1).astype(np.float32))
+        new.loops.add(quads.size)
+        new.loops.foreach_set('vertex_index', quads.reshape(-1).astype(np.int32))
+        new.polygons.add(len(quads))
+        new.polygons.foreach_set('loop_start', np.arange(0, quads.size, 4, dtype=np.int32))
+        new.polygons.foreach_set('loop_total', np.full(len(quads), 4, dtype=np.int32))
+        new.polygons.foreach_set('use_smooth', np.full(len(quads), smooth, dtype=bool))
+        new.update(calc_edges=True)
+        for material in mesh.materials:
+            new.materials.append(material)
+        for obj in bpy.data.objects:
+            if obj.data == mesh:
+                obj.data = new
+        bpy.data.meshes.remove(mesh)
+
+    def __save(self, cache_path, name, tex_path):
+        ## pack the texture so the cached file does not depend on (or re-read) the tif
+        for img in bpy.data.images:
+            if os.path.basename(img.filepath) == os.path.basename(tex_path) and img.packed_file is None:
+                img.pack()
+        ## write next to the target and move it in place, so concurrent workers never see a partial file
+        tmp_path = cache_path + '.' + str(os.getpid()) + '.tmp'
+        bpy.data.libraries.write(tmp_path, {bpy.data.objects[name]}, fake_user=True)
+        os.replace(tmp_path, cache_path)
+
+    def __append(self, cache_path, name):
+        with bpy.data.libraries.load(cache_path, link=False) as (data_from, data_to):
+            data_to.objects = [name]
+        obj = data_to.objects[0]
+        obj.use_fake_user = False
+        bpy.context.scene.objects.link(obj)
+        obj.name = name
+
     def __rename(self, old, new):
         bpy.data.objects[old].name = new
 
@@ -0,0 +1,93 @@
+import os
+import queue
+import threading
+import numpy as np
+
+from data_creation import utils
+
+
+class FrameWriter:
+    """
+    Encodes and writes captured frames on background threads, so blender can start the next render as soon as
+    the pixels are copied out. The queue holds at most max_queue frames; submit blocks when it is full, which
+    keeps memory bounded when encoding falls behind rendering.
+
+    Frames are float rgba as blender keeps them (linear, premultiplied, bottom row first) and are written as
+    8 bit srgb pngs with straight alpha, like write_still with the default view transform.
+    """
+    def __init__(self, threads=2, max_queue=8):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.lock = threading.Lock()
+        self.error = None
+        self.threads = [threading.Thread(target=self.__work) for _ in range(threads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, path, pixels, done=None):
+        """ queue pixels for path, done(path) is called (one call at a time) once the file is complete """
+        self.__raise()
+        self.queue.put((path, pixels, done))
+
+    def drain(self):
+        """ wait until every submitted frame is on disk """
+        self.queue.join()
+        self.__raise()
+
+    def close(self, discard=False):
+        """ stop the threads after writing the queued frames, or dropping them (and any error) with discard """
+        if discard:
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                self.queue.task_done()
+            self.queue.join()
+            self.error = None
+            self.__stop()
+        else:
+            ## the threads stop even when drain raises the error of a failed frame
+            try:
+                self.drain()
+            finally:
+                self.__stop()
+
+    def __stop(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def __raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def __work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            path, pixels, done = job
+            try:
+                tmp_path = path + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(utils.encode_png(self.__toImage(pixels)))
+                os.replace(tmp_path, path)
+                if done is not None:
+                    with self.lock:
+                        done(path)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def __toImage(self, pixels):
+        pixels = np.asarray(pixels, dtype=np.float32)[::-1]
+        rgb = np.clip(pixels[:, :, :3], 0., 1.)
+        alpha = np.clip(pixels[:, :, 3:], 0., 1.)
+        rgb = np.where(alpha > 0, rgb / np.maximum(alpha, 1e-6), rgb)
+        rgb = np.where(rgb <= 0.0031308, rgb * 12.92, 1.055 * np.clip(rgb, 0., 1.) ** (1 / 2.4) - 0.055)
+        return np.concatenate([rgb, alpha], axis=-1)
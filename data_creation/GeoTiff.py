@@ -0,0 +1,322 @@
+import os
+import zlib
+import struct
+from collections import OrderedDict
+import numpy as np
+
+
+class GeoTiff:
+    """
+    Minimal GeoTIFF reader for DEM / texture rasters. It only needs numpy, so it can be used outside of blender
+    (where the BlenderGIS add-on normally does the decoding).
+
+    Classic and BigTIFF (8 byte offsets, every file over 4 GiB), stripped and tiled files, uncompressed, deflate
+    or LZW compressed (with or without horizontal differencing), are supported. The file is memory mapped and
+    window() only touches the strips / tiles that overlap the window, so windows of rasters much larger than
+    memory can be read. LZW is decoded in pure python, a few MB per second, so tiling LZW rasters is slow.
+    """
+    TAG_NAMES = {256: 'width', 257: 'height', 258: 'bits_per_sample', 259: 'compression',
+                 273: 'strip_offsets', 277: 'samples_per_pixel', 278: 'rows_per_strip',
+                 279: 'strip_byte_counts', 284: 'planar_config', 317: 'predictor', 322: 'tile_width',
+                 323: 'tile_length', 324: 'tile_offsets', 325: 'tile_byte_counts', 339: 'sample_format',
+                 33550: 'pixel_scale', 33922: 'tiepoint', 34735: 'geo_keys', 34736: 'geo_doubles',
+                 34737: 'geo_ascii', 42113: 'nodata'}
+    # compression codes: none, lzw, adobe deflate, deflate
+    COMPRESSIONS = [1, 5, 8, 32946]
+    DEFLATE = [8, 32946]
+    # decoded compressed blocks kept around, windows of a tiler overlap
+    CACHED_BLOCKS = 64
+    # tiff field type -> (struct code, size in bytes)
+    FIELD_TYPES = {1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8), 6: ('b', 1),
+                   7: ('B', 1), 8: ('h', 2), 9: ('i', 4), 10: ('ii', 8), 11: ('f', 4), 12: ('d', 8),
+                   16: ('Q', 8), 17: ('q', 8), 18: ('Q', 8)}
+    # sample_format -> numpy kind
+    SAMPLE_KINDS = {1: 'u', 2: 'i', 3: 'f'}
+
+    def __init__(self, path):
+        self.path = path
+        self.tags = {}
+        with open(path, 'rb') as f:
+            self.__readHeader(f)
+        self.width = self.tags['width']
+        self.height = self.tags['height']
+        self.bands = self.tags.get('samples_per_pixel', 1)
+        bits = self.__ensureList(self.tags.get('bits_per_sample', 8))[0]
+        kind = self.SAMPLE_KINDS[self.__ensureList(self.tags.get('sample_format', 1))[0]]
+        self.dtype = np.dtype(self.byteorder + kind + str(bits // 8))
+        self.compression = self.tags.get('compression', 1)
+        self.predictor = self.tags.get('predictor', 1)
+        if self.compression not in self.COMPRESSIONS:
+            raise RuntimeError('Only uncompressed, lzw or deflate compressed tiffs are supported: ' + path)
+        if self.predictor not in [1, 2] or (self.predictor == 2 and kind == 'f'):
+            raise RuntimeError('Only integer horizontal differencing is supported as predictor: ' + path)
+        if self.bands > 1 and self.tags.get('planar_config', 1) != 1:
+            raise RuntimeError('Only pixel interleaved tiffs are supported: ' + path)
+
+        self.tiled = 'tile_offsets' in self.tags
+        if self.tiled:
+            self.block_shape = (self.tags['tile_length'], self.tags['tile_width'])
+            self.offsets = self.__ensureList(self.tags['tile_offsets'])
+            self.byte_counts = self.__ensureList(self.tags['tile_byte_counts'])
+        elif 'strip_offsets' in self.tags:
+            self.block_shape = (min(self.tags.get('rows_per_strip', self.height), self.height), self.width)
+            self.offsets = self.__ensureList(self.tags['strip_offsets'])
+            self.byte_counts = self.__ensureList(self.tags['strip_byte_counts'])
+        else:
+            raise RuntimeError('No strips or tiles found: ' + path)
+        self.blocks_across = -(-self.width // self.block_shape[1])
+        self.map = None
+        self.blocks = OrderedDict()
+
+    def __ensureList(self, inp):
+        if type(inp) not in [list, tuple]:
+            inp = [inp]
+        return inp
+
+    def __readHeader(self, f):
+        order = f.read(2)
+        if order == b'II':
+            self.byteorder = '<'
+        elif order == b'MM':
+            self.byteorder = '>'
+        else:
+            raise RuntimeError('Not a tiff file: ' + self.path)
+        magic = struct.unpack(self.byteorder + 'H', f.read(2))[0]
+        if magic == 42:
+            ## classic tiff: 4 byte offsets, entry values that fit in 4 bytes are stored in place
+            self.offset_format = 'I'
+            ifd_offset = struct.unpack(self.byteorder + 'I', f.read(4))[0]
+            count_format, entry_format = 'H', 'HHII'
+        elif magic == 43:
+            ## BigTIFF: 8 byte offsets and counts, values up to 8 bytes in place
+            self.offset_format = 'Q'
+            offset_size, _, ifd_offset = struct.unpack(self.byteorder + 'HHQ', f.read(12))
+            if offset_size != 8:
+                raise RuntimeError('Unsupported BigTIFF offset size {}: {}'.format(offset_size, self.path))
+            count_format, entry_format = 'Q', 'HHQQ'
+        else:
+            raise RuntimeError('Unsupported tiff version {}: {}'.format(magic, self.path))
+        f.seek(ifd_offset)
+        n_entries = struct.unpack(self.byteorder + count_format, f.read(struct.calcsize(count_format)))[0]
+        entry_size = struct.calcsize('=' + entry_format)
+        entries = [struct.unpack(self.byteorder + entry_format, f.read(entry_size)) for _ in range(n_entries)]
+        for code, field_type, count, value in entries:
+            if code not in self.TAG_NAMES or field_type not in self.FIELD_TYPES:
+                continue
+            self.tags[self.TAG_NAMES[code]] = self.__readValue(f, field_type, count, value)
+
+    def __readValue(self, f, field_type, count, value):
+        fmt, size = self.FIELD_TYPES[field_type]
+        nbytes = size * count
+        if nbytes <= struct.calcsize('=' + self.offset_format):
+            # values that fit are stored in the offset field itself
+            raw = struct.pack(self.byteorder + self.offset_format, value)[:nbytes]
+        else:
+            f.seek(value)
+            raw = f.read(nbytes)
+        if field_type == 2:
+            return raw.rstrip(b'\x00').decode('ascii', 'ignore')
+        values = struct.unpack(self.byteorder + fmt * count, raw)
+        if field_type in [5, 10]:
+            values = tuple(values[i] / float(values[i + 1]) for i in range(0, len(values), 2))
+        return values[0] if len(values) == 1 else values
+
+    @property
+    def shape(self):
+        if self.bands > 1:
+            return (self.height, self.width, self.bands)
+        return (self.height, self.width)
+
+    @property
+    def nodata(self):
+        if 'nodata' not in self.tags:
+            return None
+        return float(self.tags['nodata'])
+
+    @property
+    def pixel_size(self):
+        """ ground size of one pixel (x, y), defaults to 1 unit if the tif is not georeferenced """
+        if 'pixel_scale' not in self.tags:
+            return (1.0, 1.0)
+        return tuple(self.tags['pixel_scale'][:2])
+
+    @property
+    def origin(self):
+        """ georeferenced (x, y) of the upper left corner of the raster """
+        if 'tiepoint' not in self.tags:
+            return (0.0, 0.0)
+        i, j, _, x, y, _ = self.tags['tiepoint'][:6]
+        return (x - i * self.pixel_size[0], y + j * self.pixel_size[1])
+
+    @property
+    def bounds(self):
+        """ georeferenced (x min, y min, x max, y max) of the raster """
+        x, y = self.origin
+        return (x, y - self.height * self.pixel_size[1], x + self.width * self.pixel_size[0], y)
+
+    def read(self):
+        """ read the whole raster into memory as an array of shape self.shape in native byte order """
+        return self.window(0, 0, self.height, self.width)
+
+    def window(self, row, col, height, width, fill=None):
+        """
+        (height, width[, bands]) pixels starting at (row, col) in native byte order. Pixels outside of the raster
+        are set to fill (default: nodata, or 0 without a nodata value).
+        """
+        if fill is None:
+            fill = self.nodata if self.nodata is not None else 0
+        out = np.full((height, width) + self.shape[2:], fill, dtype=self.dtype.newbyteorder('='))
+        r0, r1 = max(row, 0), min(row + height, self.height)
+        c0, c1 = max(col, 0), min(col + width, self.width)
+        if r0 >= r1 or c0 >= c1:
+            return out
+        block_h, block_w = self.block_shape
+        for block_row in range(r0 // block_h, (r1 - 1) // block_h + 1):
+            for block_col in range(c0 // block_w, (c1 - 1) // block_w + 1):
+                block = self.__block(block_row * self.blocks_across + block_col)
+                top, left = block_row * block_h, block_col * block_w
+                rr0, rr1 = max(r0, top), min(r1, top + block.shape[0])
+                cc0, cc1 = max(c0, left), min(c1, left + block_w)
+                out[rr0 - row:rr1 - row, cc0 - col:cc1 - col] = block[rr0 - top:rr1 - top, cc0 - left:cc1 - left]
+        return out
+
+    def memmap(self):
+        """
+        The raster as a read-only memory mapped array, without reading or copying it. Only possible for
+        uncompressed stripped files whose strips are stored back to back (as most writers do).
+        """
+        row_bytes = self.width * self.bands * self.dtype.itemsize
+        expected = self.offsets[0] + np.arange(len(self.offsets)) * self.block_shape[0] * row_bytes
+        if self.tiled or self.compression != 1 or not np.array_equal(self.offsets, expected):
+            raise RuntimeError('Only uncompressed, contiguous stripped tiffs can be memory mapped: ' + self.path)
+        return np.memmap(self.path, dtype=self.dtype, mode='r', offset=self.offsets[0], shape=self.shape)
+
+    def __block(self, index):
+        """ decoded strip / tile as (rows, block width[, bands]), a view of the file when uncompressed """
+        if index in self.blocks:
+            self.blocks.move_to_end(index)
+            return self.blocks[index]
+        if self.map is None:
+            self.map = np.memmap(self.path, dtype=np.uint8, mode='r')
+        offset, count = self.offsets[index], self.byte_counts[index]
+        raw = self.map[offset:offset + count]
+        if self.compression in self.DEFLATE:
+            raw = np.frombuffer(zlib.decompress(raw.tobytes()), dtype=np.uint8)
+        elif self.compression == 5:
+            raw = np.frombuffer(lzw_decompress(raw.tobytes()), dtype=np.uint8)
+        block_h, block_w = self.block_shape
+        row_bytes = block_w * self.bands * self.dtype.itemsize
+        rows = min(len(raw) // row_bytes, block_h)
+        block = raw[:rows * row_bytes].view(self.dtype).reshape((rows, block_w) + self.shape[2:])
+        if self.predictor == 2:
+            native = self.dtype.newbyteorder('=')
+            block = np.cumsum(block.astype(native), axis=1, dtype=native)
+        if self.compression != 1:
+            self.blocks[index] = block
+            if len(self.blocks) > self.CACHED_BLOCKS:
+                self.blocks.popitem(last=False)
+        return block
+
+    def __repr__(self):
+        return 'GeoTiff({}, shape={}, dtype={})'.format(os.path.basename(self.path), self.shape, self.dtype)
+
+
+def lzw_decompress(data):
+    """ the tiff flavour of lzw: msb first codes of 9 to 12 bits, widened one code early """
+    table = [bytes([i]) for i in range(256)] + [b'', b'']
+    out = bytearray()
+    buffer, bits, width = 0, 0, 9
+    previous = None
+    position = 0
+    while True:
+        while bits < width:
+            if position >= len(data):
+                return bytes(out)
+            buffer = ((buffer << 8) | data[position]) & 0xffffff
+            position += 1
+            bits += 8
+        bits -= width
+        code = (buffer >> bits) & ((1 << width) - 1)
+        if code == 256:
+            ## clear code
+            del table[258:]
+            width = 9
+            previous = None
+            continue
+        if code == 257:
+            ## end of information
+            return bytes(out)
+        if code < len(table):
+            entry = table[code]
+            if previous is not None:
+                table.append(previous + entry[:1])
+        elif previous is not None:
+            entry = previous + previous[:1]
+            table.append(entry)
+        else:
+            raise RuntimeError('Corrupt lzw data')
+        out += entry
+        previous = entry
+        if len(table) + 1 >= 1 << width and width < 12:
+            width += 1
+
+
+def write_geotiff(path, array, origin, pixel_size, nodata=None, like=None, rows_per_strip=16):
+    """
+    Writes array ((height, width) or (height, width, bands)) as an uncompressed, stripped little endian GeoTIFF
+    with its upper left corner at origin (x, y) and pixels of pixel_size (x, y). The GeoKey tags (the crs) are
+    copied from the GeoTiff like, if given, so the file reads the same in the BlenderGIS add-on.
+    """
+    array = np.ascontiguousarray(array)
+    array = array.astype(array.dtype.newbyteorder('<'))
+    height, width = array.shape[:2]
+    bands = 1 if array.ndim == 2 else array.shape[2]
+    row_bytes = width * bands * array.dtype.itemsize
+    n_strips = -(-height // rows_per_strip)
+    offsets = [8 + i * rows_per_strip * row_bytes for i in range(n_strips)]
+    counts = [min(rows_per_strip, height - i * rows_per_strip) * row_bytes for i in range(n_strips)]
+    sample_format = {'u': 1, 'i': 2, 'f': 3}[array.dtype.kind]
+
+    # (code, field type, values)
+    entries = [(256, 4, [width]), (257, 4, [height]), (258, 3, [array.dtype.itemsize * 8] * bands),
+               (259, 3, [1]), (262, 3, [2 if bands >= 3 else 1]), (273, 4, offsets), (277, 3, [bands]),
+               (278, 4, [rows_per_strip]), (279, 4, counts), (284, 3, [1]), (339, 3, [sample_format] * bands),
+               (33550, 12, [pixel_size[0], pixel_size[1], 0.0]),
+               (33922, 12, [0.0, 0.0, 0.0, origin[0], origin[1], 0.0])]
+    if bands > 3:
+        entries.append((338, 3, [0] * (bands - 3)))
+    if like is not None:
+        for code, field_type, name in [(34735, 3, 'geo_keys'), (34736, 12, 'geo_doubles'), (34737, 2, 'geo_ascii')]:
+            if name in like.tags:
+                value = like.tags[name]
+                entries.append((code, field_type, value if field_type == 2 else list(np.atleast_1d(value))))
+    if nodata is not None:
+        nodata = float(nodata)
+        entries.append((42113, 2, str(int(nodata)) if nodata.is_integer() else repr(nodata)))
+    entries.sort()
+
+    codes = {1: 'B', 2: 's', 3: 'H', 4: 'I', 12: 'd'}
+    ifd_offset = 8 + array.nbytes + array.nbytes % 2
+    extra_offset = ifd_offset + 2 + 12 * len(entries) + 4
+    ifd, extra = b'', b''
+    for code, field_type, values in entries:
+        if field_type == 2:
+            raw = values.encode('ascii') + b'\x00'
+            count = len(raw)
+        else:
+            raw = struct.pack('<' + codes[field_type] * len(values), *values)
+            count = len(values)
+        if len(raw) <= 4:
+            ifd += struct.pack('<HHI', code, field_type, count) + raw.ljust(4, b'\x00')
+        else:
+            ifd += struct.pack('<HHII', code, field_type, count, extra_offset + len(extra))
+            extra += raw + b'\x00' * (len(raw) % 2)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(b'II' + struct.pack('<HI', 42, ifd_offset))
+        f.write(array.tobytes())
+        f.write(b'\x00' * (array.nbytes % 2))
+        f.write(struct.pack('<H', len(entries)) + ifd + struct.pack('<I', 0))
+        f.write(extra)
+    os.replace(tmp_path, path)
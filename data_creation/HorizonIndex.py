@@ -0,0 +1,156 @@
+import os
+import math
+import json
+import hashlib
+import numpy as np
+
+
+def disk_visibility(horizon, elevation, radius):
+    """ visible fraction of a sun disk of angular radius at elevation above a horizon elevation (radians) """
+    if radius <= 0:
+        return (horizon < elevation).astype(np.float64)
+    ## area of the part of the disk that is above the horizon line
+    s = np.clip((elevation - horizon) / radius, -1, 1)
+    return 1 - (np.arccos(s) - s * np.sqrt(1 - s ** 2)) / math.pi
+
+
+class HorizonIndex:
+    """
+    Horizon elevation angles of every DEM pixel for n_azimuths directions, so sun shadows of any sun position
+    are a lookup: a point is in hard shadow when the horizon towards the sun azimuth (interpolated between the
+    two nearest bins) is above the sun elevation, and the soft shadow is the part of the sun disk below it.
+
+    Azimuths are counter-clockwise from +x in the DEM frame (the frame of NumpyRender), bin k at 2 pi k / n.
+    Horizons lower than min_elevation are not searched for and only known to be below it.
+    The angles are stored as an (n_azimuths, rows, cols) float16 .npy (radians) with a .json header and are
+    memory mapped when loaded.
+    """
+    def __init__(self, angles, header):
+        self.angles = angles
+        self.header = header
+        self.n_azimuths = angles.shape[0]
+
+    @classmethod
+    def build(cls, renderer, n_azimuths=32, min_elevation=2.0, step_ratio=1 / 32.):
+        """
+        Marches from every pixel of the DEM loaded in renderer (a NumpyRender) towards each azimuth. Steps grow
+        with the distance (step_ratio of it, at least a pixel): far terrain subtends small angles.
+        """
+        ## marched in grid coordinates with an inlined float32 bilinear lookup, the hot loop of the build
+        heights = renderer.heights.astype(np.float32)
+        rows, cols = heights.shape
+        flat = heights.ravel()
+        grid_row, grid_col = np.mgrid[0:rows, 0:cols]
+        grid_row = grid_row.ravel().astype(np.float32)
+        grid_col = grid_col.ravel().astype(np.float32)
+        z_max = heights.max()
+        tan_min = math.tan(math.radians(min_elevation))
+        pixel = min(renderer.pixel_size)
+
+        angles = np.empty((n_azimuths, rows, cols), dtype=np.float16)
+        for k in range(n_azimuths):
+            azimuth = 2 * math.pi * k / n_azimuths
+            ## rows run north to south
+            d_row = -math.sin(azimuth) / renderer.pixel_size[1]
+            d_col = math.cos(azimuth) / renderer.pixel_size[0]
+            tan_horizon = np.full(len(flat), -np.inf, dtype=np.float32)
+            active = np.arange(len(flat))
+            distance = 0.
+            while len(active):
+                distance += max(pixel, distance * step_ratio)
+                row = grid_row[active] + distance * d_row
+                col = grid_col[active] + distance * d_col
+                inside = (row >= 0) & (row <= rows - 1) & (col >= 0) & (col <= cols - 1)
+                row = np.clip(row, 0, rows - 1)
+                col = np.clip(col, 0, cols - 1)
+                r0 = np.minimum(row.astype(np.intp), rows - 2)
+                c0 = np.minimum(col.astype(np.intp), cols - 2)
+                fr, fc = row - r0, col - c0
+                i = r0 * cols + c0
+                height = (flat[i] * (1 - fc) + flat[i + 1] * fc) * (1 - fr) + \
+                    (flat[i + cols] * (1 - fc) + flat[i + cols + 1] * fc) * fr
+                z = flat[active]
+                horizon = np.where(inside, np.maximum(tan_horizon[active], (height - z) / distance),
+                                   tan_horizon[active])
+                tan_horizon[active] = horizon
+                ## nothing further away can climb above (z_max - z) / distance
+                done = ~inside | ((z_max - z) / distance <= np.maximum(horizon, tan_min))
+                active = active[~done]
+            angles[k] = np.arctan(tan_horizon).reshape(rows, cols)
+        header = {'n_azimuths': n_azimuths, 'min_elevation': min_elevation, 'step_ratio': step_ratio,
+                  'shape': [rows, cols], 'pixel_size': list(renderer.pixel_size)}
+        return cls(angles, header)
+
+    @classmethod
+    def cached(cls, renderer, dem_path, cache_dir, n_azimuths=32, min_elevation=2.0, step_ratio=1 / 32.):
+        """
+        index of the dem loaded in renderer, built once and kept in cache_dir. The file is keyed by the dem's
+        absolute path and the build settings, and rebuilt when the dem changed (mtime or raster shape).
+        """
+        dem_path = os.path.abspath(dem_path)
+        name = os.path.basename(dem_path).split('.')[0]
+        key = hashlib.md5(json.dumps([dem_path, n_azimuths, min_elevation, step_ratio]).encode('utf-8'))
+        path = os.path.join(cache_dir, '{}_horizon{}_{}.npy'.format(name, n_azimuths, key.hexdigest()[:12]))
+        mtime = os.path.getmtime(dem_path)
+        if os.path.exists(path):
+            index = cls.load(path)
+            header = index.header
+            if header.get('dem') == dem_path and header.get('mtime') == mtime and \
+                    header.get('shape') == list(renderer.heights.shape) and \
+                    header.get('min_elevation') == min_elevation and header.get('step_ratio') == step_ratio:
+                return index
+        index = cls.build(renderer, n_azimuths, min_elevation, step_ratio)
+        index.header.update({'dem': dem_path, 'mtime': mtime})
+        index.save(path)
+        return index
+
+    def save(self, path):
+        folder = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        ## the array is moved in place before the header, a header always describes a complete array
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, self.angles)
+        os.replace(path + '.tmp', path)
+        with open(path + '.json.tmp', 'w') as f:
+            json.dump(self.header, f)
+        os.replace(path + '.json.tmp', os.path.splitext(path)[0] + '.json')
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.splitext(path)[0] + '.json') as f:
+            header = json.load(f)
+        return cls(np.load(path, mmap_mode='r'), header)
+
+    def __bins(self, azimuth):
+        position = (azimuth % (2 * math.pi)) / (2 * math.pi) * self.n_azimuths
+        low = int(position) % self.n_azimuths
+        return low, (low + 1) % self.n_azimuths, position - int(position)
+
+    def horizon(self, azimuth):
+        """ (rows, cols) horizon elevation (radians) towards azimuth """
+        low, high, weight = self.__bins(azimuth)
+        return (1 - weight) * self.angles[low].astype(np.float32) + weight * self.angles[high].astype(np.float32)
+
+    def horizonAt(self, renderer, row, col, azimuth):
+        """ horizon elevation at fractional (row, col) of the renderer's DEM grid """
+        low, high, weight = self.__bins(azimuth)
+        return (1 - weight) * renderer.sample(self.angles[low], row, col) + \
+            weight * renderer.sample(self.angles[high], row, col)
+
+    def __sun(self, sun_dir):
+        return math.atan2(sun_dir[1], sun_dir[0]), math.asin(np.clip(sun_dir[2], -1, 1))
+
+    def shadowMask(self, sun_dir):
+        """ hard shadow of every DEM pixel for a unit sun direction in the DEM frame """
+        azimuth, elevation = self.__sun(sun_dir)
+        return self.horizon(azimuth) >= elevation
+
+    def visibility(self, sun_dir, sun_size=0.0):
+        """ visible fraction of the sun disk (radius atan(sun_size), as a cycles sun lamp) for every DEM pixel """
+        azimuth, elevation = self.__sun(sun_dir)
+        return disk_visibility(self.horizon(azimuth), elevation, math.atan(sun_size))
+
+    def visibilityAt(self, renderer, row, col, sun_dir, sun_size=0.0):
+        azimuth, elevation = self.__sun(sun_dir)
+        return disk_visibility(self.horizonAt(renderer, row, col, azimuth), elevation, math.atan(sun_size))
@@ -5,16 +5,49 @@ import inspect
 
 
 class IntrinsicRender:
-    def __init__(self, x_res, y_res, use_nodes=True):
+    # modes that the 'passes' mode splits out of the single composite render
+    PASS_MODES = ['albedo', 'depth', 'normals', 'shading', 'mask', 'specular']
+    # render layer passes only the 'passes' mode reads (z and normal are used by the depth and normals modes too)
+    LAYER_PASSES = ['use_pass_object_index', 'use_pass_diffuse_color', 'use_pass_diffuse_direct',
+                    'use_pass_diffuse_indirect', 'use_pass_glossy_direct']
+    # render settings per mode: engine, cycles samples / max bounces and resolution percentage.
+    # depth and normals are render layer passes that only need the first hit. The mask is a shadeless
+    # material, which only Blender Internal honours (cycles would light and shadow it), and albedo is a lit
+    # cycles render like the composite, so both keep the settings they were rendered with before.
+    PATH_TRACED = {'engine': 'CYCLES', 'samples': 20, 'max_bounces': 5, 'resolution': 100}
+    FIRST_HIT = {'engine': 'CYCLES', 'samples': 1, 'max_bounces': 0, 'resolution': 100}
+    SHADELESS = {'engine': 'BLENDER_RENDER', 'samples': 20, 'max_bounces': 5, 'resolution': 100}
+    PROFILES = {'composite': PATH_TRACED, 'passes': PATH_TRACED, 'shading': PATH_TRACED,
+                'specular': PATH_TRACED, 'lights': PATH_TRACED, 'albedo': PATH_TRACED,
+                'depth': FIRST_HIT, 'depth_hires': FIRST_HIT, 'normals': FIRST_HIT, 'mask': SHADELESS}
+
+    def __init__(self, x_res, y_res, use_nodes=True, multilayer=False, profiles=None, setup=True):
+        self.multilayer = multilayer
+        ## per mode overrides of PROFILES, e.g. {'mask': {'engine': 'BLENDER_RENDER'}}
+        self.profiles = dict((mode, dict(profile)) for mode, profile in self.PROFILES.items())
+        for mode, profile in (profiles or {}).items():
+            self.profiles.setdefault(mode, dict(self.PATH_TRACED)).update(profile)
+        ## materials made by __color, keyed by their settings, so switching modes reuses them
+        self.material_pool = {}
+        ## (mode, name) -> compiled state, see changeMode
+        self.states = {}
+        if not setup:
+            ## the scene, compositor nodes included, was opened from a SceneTemplate
+            self.tree = bpy.context.scene.node_tree
+            return
         self.__toggleNodes(use_nodes)
         bpy.data.scenes['Scene'].render.layers['RenderLayer'].use_pass_normal = True
         if use_nodes:
             self.tree = bpy.context.scene.node_tree
-            self.__addNode('CompositorNodeNormalize')
+            norm = self.__addNode('CompositorNodeNormalize')
+            self.__linkNodes(self.tree.nodes['Render Layers'], norm, out=2)
             self.changeResolution(x_res, y_res)
             self.__initNormals()
             #self.__initNormalsMaterial()
             self.__initBackground()
+            self.__initPasses()
+            ## mirrors the Composite node, so frames can be read back without writing them (BlenderRender.capture)
+            self.__addNode('CompositorNodeViewer').name = 'Viewer'
 
     def __initNormals(self):
         render = self.tree.nodes['Render Layers']
@@ -56,6 +89,56 @@ class IntrinsicRender:
         background.inputs[1].default_value = [0., 0., 0., 1.]
         # bpy.data.scenes['Scene'].render.alpha_mode = 'TRANSPARENT'
 
+    def __initPasses(self):
+        """
+        Route the cycles render passes to a File Output node so that one render produces the composite
+        and every pass in PASS_MODES. The node is muted, and the LAYER_PASSES are off, outside of the 'passes'
+        mode, so the other renders do not pay for them.
+        """
+        layer = bpy.data.scenes['Scene'].render.layers['RenderLayer']
+        layer.use_pass_z = True
+        ## on while the outputs of the Render Layers node are linked by name
+        self.__layerPasses(True)
+
+        render = self.tree.nodes['Render Layers']
+        output = self.__addNode('CompositorNodeOutputFile')
+        output.name = 'Passes'
+        output.mute = True
+        if self.multilayer:
+            output.format.file_format = 'OPEN_EXR_MULTILAYER'
+            output.format.color_depth = '32'
+            output.layer_slots.clear()
+            for mode in self.PASS_MODES:
+                output.layer_slots.new(mode)
+        else:
+            output.format.file_format = 'PNG'
+            output.file_slots.clear()
+            for mode in self.PASS_MODES:
+                output.file_slots.new(mode)
+
+        norm = self.__addNode('CompositorNodeNormalize')
+        self.__linkNodes(render, norm, out='Depth')
+        self.__linkNodes(norm, output, inp='depth')
+        shading = self.__addNode('CompositorNodeMixRGB')
+        shading.blend_type = 'ADD'
+        self.__linkNodes(render, shading, out='DiffDir', inp=1)
+        self.__linkNodes(render, shading, out='DiffInd', inp=2)
+        self.__linkNodes(shading, output, inp='shading')
+        mask = self.__addNode('CompositorNodeIDMask')
+        mask.index = 1
+        self.__linkNodes(render, mask, out='IndexOB')
+        self.__linkNodes(mask, output, inp='mask')
+        self.__linkNodes(render, output, out='DiffCol', inp='albedo')
+        self.__linkNodes(render, output, out='Normal', inp='normals')
+        self.__linkNodes(render, output, out='GlossDir', inp='specular')
+        self.__layerPasses(False)
+
+    def __layerPasses(self, boolean):
+        layer = bpy.data.scenes['Scene'].render.layers['RenderLayer']
+        for name in self.LAYER_PASSES:
+            if getattr(layer, name) != boolean:
+                setattr(layer, name, boolean)
+
     def changeResolution(self, x_res, y_res):
         bpy.data.scenes['Scene'].render.resolution_x = x_res
         bpy.data.scenes['Scene'].render.resolution_y = y_res
@@ -106,153 +189,221 @@ class IntrinsicRender:
         bpy.data.scenes['Scene'].use_nodes = boolean
 
     def __shadeless(self, boolean):
+        ## pooled materials carry their own shadeless setting (the mask material is always shadeless)
+        pooled = set(mat.name for mat in self.material_pool.values())
         for mat in bpy.data.materials:
-            mat.use_shadeless = boolean
+            if mat.name not in pooled and mat.use_shadeless != boolean:
+                mat.use_shadeless = boolean
+
+    ################################
+    ############ Modes #############
+    ################################
 
     def changeMode(self, mode, name='shape'):
+        """
+        Every mode is compiled once (per shape name) into a declarative state, and switching only writes the
+        settings where the scene differs from that state. Comparing with the scene itself, rather than with the
+        previous mode, keeps this correct when objects are deleted and re-created for the next DEM.
+        """
+        key = (mode, name)
+        if key not in self.states:
+            self.states[key] = self.__compile(mode, name)
+        self.__apply(self.states[key])
+
+    def __compile(self, mode, name):
+        shading = name + '_shading'
+        normals = name + '_normals'
+        render = 'Render Layers'
+        ## object -> hide_render
+        original = {name: False, shading: True, normals: True, 'sphere': True}
+        duplicate = {name: True, shading: False, normals: True, 'sphere': True}
+
+        state = {
+            'hidden': original,             # hide_render per object, missing objects are skipped
+            'composite': (render, 0),       # (node, output) linked into the Composite node
+            'alpha_mode': 'SKY',
+            'file_format': 'png',
+            'shadeless': None,              # use_shadeless of the scene materials, None leaves them as they are
+            'color': None,                  # (object, __color keyword arguments) for the override material
+            'pass_index': None,             # object rendered into the mask of the passes mode
+            'passes': False,                # whether the Passes file output node and its LAYER_PASSES are active
+            'profile': self.profiles.get(mode, self.PATH_TRACED),
+        }
         if mode == 'composite':
-            self.composite()
+            state['shadeless'] = False
+        elif mode == 'passes':
+            state['shadeless'] = False
+            state['pass_index'] = name
+            state['passes'] = True
         elif mode == 'albedo':
-            self.albedo()
+            state['shadeless'] = True
         elif mode == 'depth':
-            self.depth()
+            state['composite'] = ('Normalize', 0)
         elif mode == 'depth_hires':
-            self.depth(normalize=False)
-            self.__filetype('exr')
+            state['composite'] = (render, 2)
+            state['file_format'] = 'exr'
         elif mode == 'normals':
-            self.normals(name)
-            self.__filetype('png')
+            state['hidden'] = {name: True, shading: True, normals: False}
+            if name != 'sphere':
+                state['hidden']['sphere'] = True
+            state['composite'] = (render, 3)
         elif mode == 'shading':
-            self.shading(name=name)
+            state['hidden'] = duplicate
+            state['color'] = (shading, dict(label='shading'))
         elif mode == 'mask':
-            self.mask(name=name)
+            state['hidden'] = duplicate
+            state['color'] = (shading, dict(label='mask', shadeless=True, preserve_transparency=False))
         elif mode == 'specular':
-            self.specular(name=name)
+            state['hidden'] = duplicate
+            state['color'] = (shading, dict(label='specular', diffuse_intensity=0, specular_intensity=1.0, emit=0))
         elif mode == 'lights':
-            self.lights(name)
+            state['hidden'] = {name: True, shading: True, normals: True, 'sphere': False}
+            state['color'] = ('sphere', dict(label='lights'))
+            state['composite'] = (render, 3)
+            state['alpha_mode'] = 'TRANSPARENT'
         else:
-            RuntimeError('Mode not recognized: ' + mode)
+            raise RuntimeError('Mode not recognized: ' + mode)
+        return state
 
-    def composite(self):
-        bpy.data.scenes['Scene'].render.alpha_mode = 'SKY'
-        self.__original(True)
-        self.__shadeless(False)
-        render = self.tree.nodes['Render Layers']
+    def __apply(self, state):
+        scene = bpy.data.scenes['Scene']
+        for obj_name, hidden in state['hidden'].items():
+            if obj_name in bpy.data.objects and bpy.data.objects[obj_name].hide_render != hidden:
+                bpy.data.objects[obj_name].hide_render = hidden
+
+        node, out = state['composite']
         composite = self.tree.nodes['Composite']
-        # self.__unlinkInputNodes(composite, inp=0)
-        self.__linkNodes(render, composite, out=0, inp=0)
+        links = composite.inputs[0].links
+        socket = self.tree.nodes[node].outputs[out]
+        if len(links) != 1 or links[0].from_socket != socket:
+            self.__unlinkInputNodes(composite, inp=0)
+            self.__linkNodes(self.tree.nodes[node], composite, out=out, inp=0)
+        viewer = self.tree.nodes['Viewer']
+        if len(viewer.inputs[0].links) != 1 or viewer.inputs[0].links[0].from_socket != socket:
+            self.__unlinkInputNodes(viewer, inp=0)
+            self.__linkNodes(self.tree.nodes[node], viewer, out=out, inp=0)
+
+        if scene.render.alpha_mode != state['alpha_mode']:
+            scene.render.alpha_mode = state['alpha_mode']
+        profile = state['profile']
+        if scene.render.engine != profile['engine']:
+            scene.render.engine = profile['engine']
+        if scene.cycles.samples != profile['samples']:
+            scene.cycles.samples = profile['samples']
+        if scene.cycles.max_bounces != profile['max_bounces']:
+            scene.cycles.max_bounces = profile['max_bounces']
+        if scene.render.resolution_percentage != profile['resolution']:
+            scene.render.resolution_percentage = profile['resolution']
+        self.__filetype(state['file_format'])
+        if state['shadeless'] is not None:
+            self.__shadeless(state['shadeless'])
+        if state['color'] is not None:
+            obj_name, kwargs = state['color']
+            self.__color(obj_name=obj_name, **kwargs)
+        if state['pass_index'] is not None and bpy.data.objects[state['pass_index']].pass_index != 1:
+            bpy.data.objects[state['pass_index']].pass_index = 1
+        passes = self.tree.nodes['Passes']
+        if passes.mute == state['passes']:
+            passes.mute = not state['passes']
+        self.__layerPasses(state['passes'])
+
+    def composite(self):
+        self.changeMode('composite')
+
+    def passes(self, name='shape'):
+        """
+        Composite through the Composite node plus albedo (diffuse color), depth, normals, shading (diffuse
+        direct + indirect light), mask (object index of the shape) and specular (glossy direct) through the
+        Passes file output node, all from a single render. Set the file names with passOutput before rendering.
+        """
+        self.changeMode('passes', name=name)
+
+    def passOutput(self, path, name):
+        """ name the files written by the Passes node: path/name_mode.png (or path/name_passes.exr) """
+        output = self.tree.nodes['Passes']
+        if self.multilayer:
+            output.base_path = os.path.join(path, name + '_passes')
+        else:
+            output.base_path = path
+            for slot, mode in zip(output.file_slots, self.PASS_MODES):
+                slot.path = name + '_' + mode
+
+    def collectPasses(self, path, name):
+        """ the file output node always appends the frame number, strip it after rendering """
+        frame = '{:04d}'.format(bpy.context.scene.frame_current)
+        if self.multilayer:
+            names = [name + '_passes']
+            extension = '.exr'
+        else:
+            names = [name + '_' + mode for mode in self.PASS_MODES]
+            extension = '.png'
+        for filename in names:
+            rendered = os.path.join(path, filename + frame + extension)
+            if os.path.exists(rendered):
+                os.replace(rendered, os.path.join(path, filename + extension))
 
     def albedo(self):
-        self.__original(True)
-        self.__shadeless(True)
-        render = self.tree.nodes['Render Layers']
-        composite = self.tree.nodes['Composite']
-        # self.__unlinkInputNodes(composite, inp=0)
-        self.__linkNodes(render, composite, out=0, inp=0)
+        self.changeMode('albedo')
 
     def __filetype(self, extension):
+        settings = bpy.context.scene.render.image_settings
         if extension == 'png':
-            bpy.context.scene.render.image_settings.file_format = 'PNG'
+            if settings.file_format != 'PNG':
+                settings.file_format = 'PNG'
         elif extension == 'exr':
-            bpy.context.scene.render.image_settings.file_format = 'OPEN_EXR'
-            bpy.context.scene.render.image_settings.color_depth = '32'
+            if settings.file_format != 'OPEN_EXR':
+                settings.file_format = 'OPEN_EXR'
+                settings.color_depth = '32'
         else:
             raise RuntimeError('Unrecognized filetpye: ', extension)
 
     def depth(self, normalize=True):
-        self.__original(True)
-        render = self.tree.nodes['Render Layers']
-        composite = self.tree.nodes['Composite']
-        if normalize:
-            norm = self.tree.nodes['Normalize']
-            self.__linkNodes(render, norm, out=2)
-            self.__linkNodes(norm, composite)
-        else:
-            self.__linkNodes(render, composite, out=2)
+        self.changeMode('depth' if normalize else 'depth_hires')
 
     def normals(self, name):
-        bpy.data.objects[name].hide_render = True
-        bpy.data.objects[name + '_shading'].hide_render = True
-        bpy.data.objects[name + '_normals'].hide_render = False
-        if name != 'sphere':
-            bpy.data.objects['sphere'].hide_render = True
-        # self.__original(True)
-        self.__normalsPass(False)
-
-    def __normalsPass(self, boolean):
-        render = self.tree.nodes['Render Layers']
-        background = self.tree.nodes['Mix.002']
-        # invert = self.tree.nodes['Invert']
-        composite = self.tree.nodes['Composite']
-        if boolean:
-            bpy.data.scenes['Scene'].render.alpha_mode = 'TRANSPARENT'
-            self.__linkNodes(background, composite)
-        else:
-            bpy.data.scenes['Scene'].render.alpha_mode = 'SKY'
-            self.__unlinkInputNodes(composite, inp=0)
-            self.__linkNodes(render, composite, out=3, inp=0)
+        self.changeMode('normals', name=name)
 
     def lights(self, name):
-        if name in bpy.data.objects:
-            bpy.data.objects[name].hide_render = True
-            bpy.data.objects[name + '_shading'].hide_render = True
-            bpy.data.objects[name + '_normals'].hide_render = True
-        bpy.data.objects['sphere'].hide_render = False
-        # bpy.data.materials['sphere'].use_shadeless = False
-        self.__color(label='lights', obj_name='sphere')
-        self.__normalsPass(False)
-        bpy.data.scenes['Scene'].render.alpha_mode = 'TRANSPARENT'
+        self.changeMode('lights', name=name)
 
     def shading(self, name='shape'):
-        self.__original(False, name=name)
-        self.__normalsPass(False)
-        # self.__shadeless(False)
-        render = self.tree.nodes['Render Layers']
-        composite = self.tree.nodes['Composite']
-        self.__linkNodes(render, composite)
-        self.__color(label='shading', obj_name=name + '_shading')
+        self.changeMode('shading', name=name)
 
     def mask(self, name='shape'):
-        self.__original(False, name=name)
-        self.__normalsPass(False)
-        render = self.tree.nodes['Render Layers']
-        composite = self.tree.nodes['Composite']
-        self.__linkNodes(render, composite)
-        self.__color(label='mask', obj_name=name + '_shading', shadeless=True, preserve_transparency=False)
+        self.changeMode('mask', name=name)
 
     def specular(self, name='shape'):
-        self.__original(False, name=name)
-        self.__color(label='specular', obj_name=name + '_shading', diffuse_intensity=0, specular_intensity=1.0, emit=0)
+        self.changeMode('specular', name=name)
 
     def __color(self, label='shading', obj_name='shape_shading', diffuse_intensity=0.8, specular_intensity=0.5,
                 emit=0.05, shadeless=False, preserve_transparency=True):
         obj = bpy.data.objects[obj_name]
-        for ind in range(len(obj.data.materials)):
-            old = obj.data.materials[ind]
+        ## material_slots follow the slot link, so linked duplicates get object level materials
+        for ind in range(len(obj.material_slots)):
+            slot = obj.material_slots[ind]
+            ## transparency comes from the mesh material, not from the override of the previous mode
+            old = obj.data.materials[ind] if slot.link == 'OBJECT' else slot.material
             trans = old.use_transparency and preserve_transparency
-            mat = bpy.data.materials.new(label + '_' + str(ind))
-            mat.diffuse_intensity = diffuse_intensity
-            mat.specular_intensity = specular_intensity
-            mat.diffuse_color = (1, 1, 1)
-            mat.specular_color = (1, 1, 1)
-            mat.emit = emit
-            mat.use_shadeless = shadeless
-            mat.use_transparency = trans
-            if trans:
-                mat.alpha = old.alpha
-            obj.data.materials[ind] = mat
-
-    ''' Show original mesh
-    or duplicated mesh '''
-
-    def __original(self, boolean, name='shape'):
-        if boolean:
-            obj = bpy.data.objects[name].hide_render = False
-            obj = bpy.data.objects[name + '_shading'].hide_render = True
-            obj = bpy.data.objects[name + '_normals'].hide_render = True
-            obj = bpy.data.objects['sphere'].hide_render = True
-        else:
-            obj = bpy.data.objects[name].hide_render = True
-            obj = bpy.data.objects[name + '_shading'].hide_render = False
-            obj = bpy.data.objects[name + '_normals'].hide_render = True
-            obj = bpy.data.objects['sphere'].hide_render = True
+            alpha = old.alpha if trans else None
+            key = (label, diffuse_intensity, specular_intensity, emit, shadeless, trans, alpha)
+            if key not in self.material_pool:
+                mat = bpy.data.materials.new(label + '_' + str(len(self.material_pool)))
+                mat.diffuse_intensity = diffuse_intensity
+                mat.specular_intensity = specular_intensity
+                mat.diffuse_color = (1, 1, 1)
+                mat.specular_color = (1, 1, 1)
+                mat.emit = emit
+                mat.use_shadeless = shadeless
+                mat.use_transparency = trans
+                if trans:
+                    mat.alpha = alpha
+                self.material_pool[key] = mat
+            if slot.material != self.material_pool[key]:
+                slot.material = self.material_pool[key]
+
+    def datablocks(self):
+        """ number of datablocks of each kind, to check that long runs do not keep growing bpy.data """
+        counts = {'pooled_materials': len(self.material_pool)}
+        for kind in ['materials', 'meshes', 'objects', 'images', 'textures', 'lamps', 'node_groups']:
+            counts[kind] = len(getattr(bpy.data, kind))
+        return counts
@@ -0,0 +1,106 @@
+import os
+import json
+import time
+import socket
+
+
+class JobQueue:
+    """
+    File based job queue shared by the long-lived blender workers of one machine (render.py --queue).
+    A job is a json file that moves between the folders pending/ -> running/ -> done/ or failed/. Moves are
+    os.replace / os.rename calls within one file system, so each job is claimed by exactly one worker and a
+    crash never leaves a half written job. A STOP file in the root tells idle workers to exit.
+    """
+    STATES = ['pending', 'running', 'done', 'failed']
+
+    def __init__(self, root):
+        self.root = root
+        for state in self.STATES:
+            if not os.path.exists(os.path.join(root, state)):
+                os.makedirs(os.path.join(root, state))
+
+    def __path(self, state, name):
+        return os.path.join(self.root, state, name)
+
+    def submit(self, job, name):
+        """ queue job (a json serializable dict) under a unique name """
+        job = dict(job, name=name)
+        tmp_path = self.__path('pending', '.' + name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmp_path, self.__path('pending', name + '.json'))
+        return name
+
+    def claim(self, worker):
+        """ move the oldest pending job to running/ for worker and return it, None if there is none """
+        for filename in sorted(os.listdir(os.path.join(self.root, 'pending'))):
+            if not filename.endswith('.json'):
+                continue
+            target = self.__path('running', worker + '.' + filename)
+            try:
+                os.rename(self.__path('pending', filename), target)
+            except OSError:
+                ## another worker was faster
+                continue
+            with open(target) as f:
+                job = json.load(f)
+            job['worker'] = worker
+            return job
+
+    def finish(self, job, error=None):
+        """ move a claimed job to done/ (or failed/ with the error) """
+        running = self.__path('running', job['worker'] + '.' + job['name'] + '.json')
+        state = 'done' if error is None else 'failed'
+        record = dict(job, error=error, finished=time.time())
+        with open(running, 'w') as f:
+            json.dump(record, f)
+        os.replace(running, self.__path(state, job['name'] + '.json'))
+
+    def release(self, worker):
+        """ put the running jobs of a dead worker back in pending/, returns their names """
+        names = []
+        prefix = worker + '.'
+        for filename in os.listdir(os.path.join(self.root, 'running')):
+            if filename.startswith(prefix):
+                name = filename[len(prefix):]
+                os.replace(self.__path('running', filename), self.__path('pending', name))
+                names.append(name[:-len('.json')])
+        return names
+
+    def status(self, name):
+        for state in self.STATES:
+            if state == 'running':
+                if any(f.endswith('.' + name + '.json') for f in os.listdir(os.path.join(self.root, state))):
+                    return state
+            elif os.path.exists(self.__path(state, name + '.json')):
+                return state
+        return None
+
+    def result(self, name):
+        """ the record of a done / failed job """
+        for state in ['done', 'failed']:
+            path = self.__path(state, name + '.json')
+            if os.path.exists(path):
+                with open(path) as f:
+                    return json.load(f)
+
+    def remove(self, name):
+        """ drop a job that is not running """
+        for state in ['pending', 'done', 'failed']:
+            path = self.__path(state, name + '.json')
+            if os.path.exists(path):
+                os.remove(path)
+
+    def stop(self):
+        open(os.path.join(self.root, 'STOP'), 'w').close()
+
+    def stopped(self):
+        return os.path.exists(os.path.join(self.root, 'STOP'))
+
+    def clearStop(self):
+        if self.stopped():
+            os.remove(os.path.join(self.root, 'STOP'))
+
+
+def worker_name():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
@@ -0,0 +1,81 @@
+import os
+import json
+import hashlib
+import threading
+
+
+class Manifest:
+    """
+    Append-only log of the (index, mode) outputs that finished rendering, one json line per file with its
+    size and md5. Every line is flushed and fsynced as it is written, so after a crash or pre-emption the
+    manifest only lists files that are complete, and a restarted run can skip them.
+    File paths are stored relative to the manifest, so an output folder can be moved or merged as a whole.
+    record may be called from several threads (FrameWriter callbacks and the render loop).
+    Entries of base manifests (e.g. the merged manifest of a sharded run's output) count as done too, so a
+    shard re-created after a merge skips what was already merged.
+    """
+    NAME = 'manifest.jsonl'
+
+    def __init__(self, path, verify=False, base=()):
+        self.path = path
+        self.root = os.path.dirname(os.path.abspath(path))
+        self.verify = verify
+        self.entries = {}
+        self.lock = threading.Lock()
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        for base_path in base:
+            if os.path.exists(base_path):
+                self.__read(base_path)
+        if os.path.exists(path):
+            self.__read(path)
+        self.file = open(path, 'a')
+
+    def __read(self, path):
+        root = os.path.dirname(os.path.abspath(path))
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    ## torn last line of a crashed run
+                    continue
+                if root != self.root:
+                    entry['file'] = os.path.relpath(os.path.join(root, entry['file']), self.root)
+                self.entries[(entry['index'], entry['mode'])] = entry
+
+    def checksum(self, path):
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                md5.update(block)
+        return md5.hexdigest()
+
+    def done(self, index, mode):
+        """ whether (index, mode) was recorded and its file is still there and complete """
+        entry = self.entries.get((index, mode))
+        if entry is None:
+            return False
+        path = os.path.join(self.root, entry['file'])
+        if not os.path.exists(path) or os.path.getsize(path) != entry['size']:
+            return False
+        if self.verify and self.checksum(path) != entry['md5']:
+            return False
+        return True
+
+    def finished(self, indices, modes):
+        return all(self.done(index, mode) for index in indices for mode in modes)
+
+    def record(self, index, mode, path):
+        entry = {'index': int(index), 'mode': mode, 'file': os.path.relpath(os.path.abspath(path), self.root),
+                 'size': os.path.getsize(path), 'md5': self.checksum(path)}
+        ## the checksum is computed outside the lock, only the write and the bookkeeping are serialized
+        with self.lock:
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.entries[(entry['index'], mode)] = entry
+
+    def close(self):
+        with self.lock:
+            self.file.close()
@@ -0,0 +1,297 @@
+import os, math
+import numpy as np
+from data_creation import utils
+from data_creation.GeoTiff import GeoTiff
+from data_creation.HorizonIndex import disk_visibility
+
+
+class NumpyRender:
+    """
+    Blender-free renderer for DEM tiles. Mirrors the scene that BlenderRender / DEMRender / IntrinsicRender set up
+    (orthographic camera tracking the origin, a sun lamp and a heightfield rotated about z) and produces the
+    composite, shading and cast shadow images with vectorized ray marching in numpy.
+
+    All the work is done in the frame of the DEM: rotating the DEM by dsm_euler is the same as rotating the
+    camera and the sun by the inverse rotation.
+    """
+    def __init__(self, dem_root_path, tex_root_path, x_res=512, y_res=512, ortho_scale=256, max_load=-1,
+                 ambient=0.0):
+        self.dem_paths, self.tex_paths = utils.dem_paths(dem_root_path, tex_root_path, max_load)
+
+        self.x_res = x_res
+        self.y_res = y_res
+        self.ortho_scale = ortho_scale
+        self.ambient = ambient
+        ## HorizonIndex of the loaded DEM, when set shadows are looked up instead of marched
+        self.horizon_index = None
+        self.translate([0.0, 0.0, 128.0])
+        self.rotateSun([0.0, 0.0, 0.0])
+        self.sun(3.0, 0.1)
+        self.rotate([0.0, 0.0, 0.0])
+
+    def load(self, index):
+        dem = GeoTiff(self.dem_paths[index])
+        heights = dem.read().astype(np.float64)
+        if heights.ndim == 3:
+            heights = heights[:, :, 0]
+        valid = np.isfinite(heights)
+        if dem.nodata is not None:
+            valid &= heights != dem.nodata
+        heights[~valid] = heights[valid].min()
+        self.heights = heights
+        self.pixel_size = dem.pixel_size
+        self.horizon_index = None
+
+        tex = GeoTiff(self.tex_paths[index]).read()
+        if tex.ndim == 2:
+            tex = np.stack([tex] * 3, axis=-1)
+        self.albedo = self.__toLinear(tex[:, :, :3].astype(np.float64) / np.iinfo(tex.dtype).max)
+
+        ## normals of the heightfield, rows run north to south so y is flipped
+        dz_dy, dz_dx = np.gradient(heights)
+        normals = np.stack([-dz_dx / self.pixel_size[0], dz_dy / self.pixel_size[1], np.ones_like(heights)], axis=-1)
+        self.normals = normals / np.linalg.norm(normals, axis=-1, keepdims=True)
+
+    ################################
+    ############ Scene #############
+    ################################
+
+    def translate(self, coords):
+        """ camera location, the camera always looks at the origin (the damped track constraint in BlenderRender) """
+        self.camera_loc = np.array(coords, dtype=np.float64)
+
+    def rotateSun(self, angles):
+        self.sun_euler = np.array(angles, dtype=np.float64)
+
+    def sun(self, energy, sun_size):
+        self.energy = energy
+        self.sun_size = sun_size
+
+    def rotate(self, angles):
+        self.dsm_euler = np.array(angles, dtype=np.float64)
+
+    def __toRadians(self, degree):
+        return degree * math.pi / 180.
+
+    def __euler(self, angles):
+        """ rotation matrix of a blender XYZ euler in degrees """
+        x, y, z = [self.__toRadians(a) for a in angles]
+        rx = np.array([[1, 0, 0], [0, math.cos(x), -math.sin(x)], [0, math.sin(x), math.cos(x)]])
+        ry = np.array([[math.cos(y), 0, math.sin(y)], [0, 1, 0], [-math.sin(y), 0, math.cos(y)]])
+        rz = np.array([[math.cos(z), -math.sin(z), 0], [math.sin(z), math.cos(z), 0], [0, 0, 1]])
+        return rz.dot(ry).dot(rx)
+
+    def __toLinear(self, srgb):
+        return np.where(srgb <= 0.04045, srgb / 12.92, ((srgb + 0.055) / 1.055) ** 2.4)
+
+    def __toSRGB(self, linear):
+        linear = np.clip(linear, 0., 1.)
+        return np.where(linear <= 0.0031308, linear * 12.92, 1.055 * linear ** (1 / 2.4) - 0.055)
+
+    def cameraRays(self):
+        """
+        Origins and (shared) direction of the camera rays in the DEM frame, one per output pixel.
+        The camera basis is the shortest rotation taking -z onto the view direction, which is what the
+        DAMPED_TRACK / TRACK_NEGATIVE_Z constraint does to the unrotated camera.
+        """
+        to_dem = self.__euler(self.dsm_euler).T
+        view = -self.camera_loc / np.linalg.norm(self.camera_loc)
+        axis = np.cross([0., 0., -1.], view)
+        cos = -view[2]
+        skew = np.array([[0, -axis[2], axis[1]], [axis[2], 0, -axis[0]], [-axis[1], axis[0], 0]])
+        basis = np.eye(3) + skew + skew.dot(skew) / max(1. + cos, 1e-12)
+        right, up = basis[:, 0], basis[:, 1]
+
+        ## blender fits ortho_scale to the larger side of the image
+        pixel = self.ortho_scale / float(max(self.x_res, self.y_res))
+        u = (np.arange(self.x_res) + 0.5 - self.x_res / 2.) * pixel
+        v = (self.y_res / 2. - np.arange(self.y_res) - 0.5) * pixel
+        u, v = np.meshgrid(u, v)
+        origins = self.camera_loc + u[..., np.newaxis] * right + v[..., np.newaxis] * up
+        return origins.reshape(-1, 3).dot(to_dem.T), to_dem.dot(view)
+
+    def sunDirection(self):
+        """ unit vector pointing towards the sun in the DEM frame (the lamp shines along its local -z) """
+        to_dem = self.__euler(self.dsm_euler).T
+        return to_dem.dot(self.__euler(self.sun_euler).dot([0., 0., 1.]))
+
+    ################################
+    ########## Sampling ############
+    ################################
+
+    def toGrid(self, xy):
+        """ world (x, y) in the DEM frame -> fractional (row, col), the DEM is centered on the origin """
+        rows, cols = self.heights.shape
+        col = xy[..., 0] / self.pixel_size[0] + cols / 2. - 0.5
+        row = rows / 2. - 0.5 - xy[..., 1] / self.pixel_size[1]
+        return row, col
+
+    def inside(self, row, col):
+        rows, cols = self.heights.shape
+        return (row >= 0) & (row <= rows - 1) & (col >= 0) & (col <= cols - 1)
+
+    def sample(self, grid, row, col):
+        """ bilinear lookup of grid at fractional (row, col), clamped at the borders """
+        rows, cols = grid.shape[:2]
+        row = np.clip(row, 0, rows - 1)
+        col = np.clip(col, 0, cols - 1)
+        r0 = np.minimum(row.astype(np.intp), rows - 2)
+        c0 = np.minimum(col.astype(np.intp), cols - 2)
+        fr = row - r0
+        fc = col - c0
+        if grid.ndim == 3:
+            fr = fr[:, np.newaxis]
+            fc = fc[:, np.newaxis]
+        top = grid[r0, c0] * (1 - fc) + grid[r0, c0 + 1] * fc
+        bottom = grid[r0 + 1, c0] * (1 - fc) + grid[r0 + 1, c0 + 1] * fc
+        return top * (1 - fr) + bottom * fr
+
+    ################################
+    ######### Ray marching #########
+    ################################
+
+    def castRays(self, origins, direction):
+        """
+        March all rays through the slab [min height, max height] at half a DEM pixel per step and refine the
+        first crossing linearly. Returns the hit points and a mask of the rays that hit the DEM.
+        """
+        z_min, z_max = self.heights.min(), self.heights.max()
+        if direction[2] >= 0:
+            raise RuntimeError('Camera has to look down on the DEM: ' + str(direction))
+        t_enter = (origins[:, 2] - z_max) / -direction[2]
+        t_span = (z_max - z_min) / -direction[2]
+        horizontal = np.linalg.norm(direction[:2]) * t_span
+        n_steps = max(1, int(math.ceil(horizontal / (0.5 * min(self.pixel_size)))))
+        dt = t_span / n_steps
+
+        t_hit = np.full(len(origins), np.nan)
+        active = np.arange(len(origins))
+        t_prev = t_enter.copy()
+        points = origins + t_enter[:, np.newaxis] * direction
+        f_prev = points[:, 2] - self.sample(self.heights, *self.toGrid(points[:, :2]))
+        for step in range(1, n_steps + 1):
+            t = t_enter[active] + step * dt
+            points = origins[active] + t[:, np.newaxis] * direction
+            row, col = self.toGrid(points[:, :2])
+            f = points[:, 2] - self.sample(self.heights, row, col)
+            crossed = f <= 0
+            if crossed.any():
+                fp = f_prev[active][crossed]
+                fc = f[crossed]
+                tp = t_prev[active][crossed]
+                t_hit[active[crossed]] = tp + fp / np.maximum(fp - fc, 1e-12) * (t[crossed] - tp)
+            t_prev[active] = t
+            f_prev[active] = f
+            active = active[~crossed]
+            if len(active) == 0:
+                break
+
+        mask = np.isfinite(t_hit)
+        points = origins + np.nan_to_num(t_hit)[:, np.newaxis] * direction
+        row, col = self.toGrid(points[:, :2])
+        mask &= self.inside(row, col)
+        return points, mask
+
+    def sunVisibility(self, points, sun_dir):
+        """
+        Fraction of the sun disk that is visible from each point. The horizon elevation along the sun azimuth is
+        found by marching towards the sun one DEM pixel at a time; points drop out as soon as they are fully lit
+        or fully shadowed. The sun is a disk of angular radius atan(sun_size), as for a cycles sun lamp.
+        """
+        elevation = math.asin(np.clip(sun_dir[2], -1, 1))
+        radius = math.atan(self.sun_size)
+        azimuth = sun_dir[:2] / max(np.linalg.norm(sun_dir[:2]), 1e-12)
+        if np.linalg.norm(sun_dir[:2]) < 1e-6 or elevation - radius >= math.pi / 2:
+            return np.ones(len(points))
+
+        tan_high = math.tan(min(elevation + radius, math.pi / 2 - 1e-6))
+        tan_low = math.tan(max(elevation - radius, 1e-3))
+        z_max = self.heights.max()
+        step = min(self.pixel_size)
+        max_steps = int(math.ceil(np.hypot(*self.heights.shape) * max(self.pixel_size) / step))
+
+        tan_horizon = np.full(len(points), -np.inf)
+        active = np.arange(len(points))
+        for k in range(1, max_steps + 1):
+            distance = k * step
+            xy = points[active, :2] + distance * azimuth
+            row, col = self.toGrid(xy)
+            inside = self.inside(row, col)
+            rise = (self.sample(self.heights, row, col) - points[active, 2]) / distance
+            tan_horizon[active] = np.where(inside, np.maximum(tan_horizon[active], rise), tan_horizon[active])
+            ## nothing further away can climb above (z_max - z) / distance
+            bound = (z_max - points[active, 2]) / distance
+            done = ~inside | (tan_horizon[active] >= tan_high) | (bound <= np.maximum(tan_horizon[active], tan_low))
+            active = active[~done]
+            if len(active) == 0:
+                break
+
+        return disk_visibility(np.arctan(tan_horizon), elevation, radius)
+
+    ################################
+    ########### Render #############
+    ################################
+
+    def render(self, geometry=False):
+        """
+        returns a dict of float images in [0, 1]: composite (rgb), shading and shadow, and with geometry the
+        passes of geometry() from the same camera rays
+        """
+        origins, direction = self.cameraRays()
+        points, mask = self.castRays(origins, direction)
+        row, col = self.toGrid(points[mask, :2])
+        sun_dir = self.sunDirection()
+
+        normals = self.sample(self.normals, row, col)
+        lambert = np.maximum(normals.dot(sun_dir), 0)
+        if self.horizon_index is not None:
+            visibility = self.horizon_index.visibilityAt(self, row, col, sun_dir, self.sun_size)
+        else:
+            visibility = self.sunVisibility(points[mask], sun_dir)
+        ## cycles diffuse: radiance = albedo * irradiance * cos / pi
+        irradiance = self.energy * lambert * visibility / math.pi + self.ambient
+
+        shape = (self.y_res, self.x_res)
+        shading = np.zeros(len(points))
+        shadow = np.zeros(len(points))
+        composite = np.zeros((len(points), 3))
+        shading[mask] = irradiance
+        shadow[mask] = 1 - visibility
+        composite[mask] = self.sample(self.albedo, row, col) * irradiance[:, np.newaxis]
+        images = {'composite': self.__toSRGB(composite).reshape(shape + (3,)),
+                  'shading': self.__toSRGB(shading).reshape(shape),
+                  'shadow': shadow.reshape(shape)}
+        if geometry:
+            images.update(self.geometry(origins, direction, points, mask))
+        return images
+
+    def geometry(self, origins=None, direction=None, points=None, mask=None):
+        """
+        The lighting independent passes, exact for an orthographic camera over a heightfield:
+        depth (distance from the image plane, normalized over the DEM like the Normalize node, background 1),
+        normals (the raw world frame normal pass IntrinsicRender links to the Composite node, so negative
+        components are clipped, background 0), mask (1 on the DEM) and albedo (the texture as it is stored,
+        background 0). Camera rays and hits of render() can be passed in.
+        Depth and normals go through the srgb display transform blender applies when it writes them as pngs.
+        """
+        if origins is None:
+            origins, direction = self.cameraRays()
+        if points is None:
+            points, mask = self.castRays(origins, direction)
+        row, col = self.toGrid(points[mask, :2])
+        shape = (self.y_res, self.x_res)
+
+        depth = np.ones(len(points))
+        if mask.any():
+            distance = (points[mask] - origins[mask]).dot(direction)
+            depth[mask] = (distance - distance.min()) / max(distance.max() - distance.min(), 1e-12)
+        ## normals back from the DEM frame into the world frame
+        to_world = self.__euler(self.dsm_euler)
+        normals = np.zeros((len(points), 3))
+        normals[mask] = self.__toSRGB(self.sample(self.normals, row, col).dot(to_world.T))
+        albedo = np.zeros((len(points), 3))
+        albedo[mask] = self.__toSRGB(self.sample(self.albedo, row, col))
+        return {'depth': self.__toSRGB(depth).reshape(shape),
+                'normals': normals.reshape(shape + (3,)),
+                'mask': mask.astype(np.float64).reshape(shape),
+                'albedo': albedo.reshape(shape + (3,))}
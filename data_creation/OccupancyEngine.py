@@ -0,0 +1,190 @@
+import multiprocessing
+import numpy as np
+
+
+class OccupancyEngine:
+    """
+    Labels occupancy points against a triangle mesh with numpy instead of two scene.ray_cast calls per point.
+
+    The labels follow blender-render-tree.py: a point is occupied when the segment from the point to the ray
+    origin (the camera) hits the model and so does the ray from the point away from the origin, i.e. when it lies
+    between the first and the last surface seen along the line of sight.
+    Every ray starts at the same origin, so a ray is a single point after a perspective projection along the
+    viewing direction. Triangles are binned once per origin into a grid over that projection and each point is
+    only tested (Moller-Trumbore) against the triangles of its cell.
+    """
+    # (point, triangle) pairs intersected at once, bounds the memory of a batch
+    PAIRS = 1 << 20
+
+    def __init__(self, vertices, faces):
+        triangles = np.asarray(vertices, dtype=np.float64)[np.asarray(faces, dtype=np.int64)]
+        self.v0 = triangles[:, 0]
+        self.e1 = triangles[:, 1] - self.v0
+        self.e2 = triangles[:, 2] - self.v0
+        self.triangles = triangles
+        self.lo = triangles.reshape(-1, 3).min(axis=0)
+        self.hi = triangles.reshape(-1, 3).max(axis=0)
+        self.grids = {}
+
+    @classmethod
+    def load(cls, path):
+        """ mesh saved by blender-render-tree.py export_scene(..., ext='npz') """
+        data = np.load(path)
+        return cls(data['vertices'], data['faces'])
+
+    def __len__(self):
+        return len(self.triangles)
+
+    def label(self, points, origin, batch=65536, processes=1):
+        """ occupancy (bool, (n,)) of points (n, 3) for rays cast from origin """
+        points = np.asarray(points, dtype=np.float64)
+        origin = np.asarray(origin, dtype=np.float64)
+        grid = self.__grid(origin)
+        chunks = [points[i:i + batch] for i in range(0, len(points), batch)]
+        if processes > 1 and len(chunks) > 1:
+            ## workers are forked, the mesh and the grid are shared copy-on-write instead of pickled
+            pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(self, origin))
+            try:
+                labels = pool.map(_label_worker, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            labels = [self.__label(chunk, origin, grid) for chunk in chunks]
+        if not labels:
+            return np.zeros(0, dtype=bool)
+        return np.concatenate(labels)
+
+    ################################
+    ############ Grid ##############
+    ################################
+
+    def __grid(self, origin):
+        key = tuple(origin)
+        if key not in self.grids:
+            self.grids = {key: self.__build(origin)}
+        return self.grids[key]
+
+    def __basis(self, origin):
+        forward = (self.lo + self.hi) / 2 - origin
+        forward /= np.linalg.norm(forward)
+        helper = np.array([0., 0., 1.]) if abs(forward[2]) < 0.9 else np.array([1., 0., 0.])
+        right = np.cross(forward, helper)
+        right /= np.linalg.norm(right)
+        return forward, right, np.cross(right, forward)
+
+    def __project(self, vectors, basis):
+        forward, right, up = basis
+        depth = vectors.dot(forward)
+        safe = np.where(depth > 1e-9, depth, 1.)
+        return vectors.dot(right) / safe, vectors.dot(up) / safe, depth
+
+    def __build(self, origin):
+        basis = self.__basis(origin)
+        x, y, depth = self.__project(self.triangles - origin, basis)
+        ## triangles reaching behind the projection plane are tested against every point
+        front = (depth > 1e-9).all(axis=1)
+        behind = np.flatnonzero(~front)
+        front = np.flatnonzero(front)
+        x, y = x[front], y[front]
+        x0, x1, y0, y1 = x.min(axis=1), x.max(axis=1), y.min(axis=1), y.max(axis=1)
+
+        grid = {'basis': basis, 'behind': behind}
+        if len(front) == 0:
+            grid['size'] = 0
+            return grid
+        ## roughly one cell per triangle, over the extent of the projected mesh
+        size = int(np.clip(np.sqrt(len(front)), 1, 2048))
+        low = np.array([x0.min(), y0.min()])
+        scale = size / np.maximum(np.array([x1.max(), y1.max()]) - low, 1e-12)
+        cx0 = np.clip(((x0 - low[0]) * scale[0]).astype(np.int64), 0, size - 1)
+        cx1 = np.clip(((x1 - low[0]) * scale[0]).astype(np.int64), 0, size - 1)
+        cy0 = np.clip(((y0 - low[1]) * scale[1]).astype(np.int64), 0, size - 1)
+        cy1 = np.clip(((y1 - low[1]) * scale[1]).astype(np.int64), 0, size - 1)
+        nx, ny = cx1 - cx0 + 1, cy1 - cy0 + 1
+        counts = nx * ny
+        ## every (triangle, covered cell) pair, sorted by cell into csr arrays
+        owner = np.repeat(np.arange(len(front)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cells = (cy0[owner] + local // nx[owner]) * size + cx0[owner] + local % nx[owner]
+        order = np.argsort(cells, kind='stable')
+        grid.update({'size': size, 'low': low, 'scale': scale, 'triangles': front[owner[order]],
+                     'offsets': np.searchsorted(cells[order], np.arange(size * size + 1))})
+        return grid
+
+    ################################
+    ########### Labels #############
+    ################################
+
+    def __label(self, points, origin, grid):
+        directions = points - origin
+        distance = np.linalg.norm(directions, axis=1)
+        directions = directions / np.maximum(distance, 1e-12)[:, None]
+        before = np.zeros(len(points), dtype=bool)
+        after = np.zeros(len(points), dtype=bool)
+
+        for point_ids, triangle_ids in self.__chunks(points, origin, grid):
+            hit, t = self.__intersect(origin, directions[point_ids], triangle_ids)
+            point_ids, t = point_ids[hit], t[hit]
+            before[point_ids[t < distance[point_ids]]] = True
+            after[point_ids[t > distance[point_ids]]] = True
+        return before & after
+
+    def __chunks(self, points, origin, grid):
+        """ the candidate (point, triangle) pairs in chunks of at most PAIRS """
+        point_ids, triangle_ids = self.__pairs(points, origin, grid)
+        for i in range(0, len(point_ids), self.PAIRS):
+            yield point_ids[i:i + self.PAIRS], triangle_ids[i:i + self.PAIRS]
+        ## triangles behind the projection plane pair with every point (many when the origin is inside the mesh
+        ## bounds), so the cross product is built a block of points and triangles at a time
+        behind = grid['behind']
+        for j in range(0, len(behind), self.PAIRS):
+            triangles = behind[j:j + self.PAIRS]
+            step = max(1, self.PAIRS // len(triangles))
+            for i in range(0, len(points), step):
+                ids = np.arange(i, min(i + step, len(points)))
+                yield np.repeat(ids, len(triangles)), np.tile(triangles, len(ids))
+
+    def __pairs(self, points, origin, grid):
+        """ (point, triangle) candidates: the triangles binned in the cell each point projects to """
+        if grid['size'] == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        size = grid['size']
+        x, y, depth = self.__project(points - origin, grid['basis'])
+        cx = np.floor((x - grid['low'][0]) * grid['scale'][0])
+        cy = np.floor((y - grid['low'][1]) * grid['scale'][1])
+        ## rays outside the grid (or pointing away from it) cannot hit a triangle in front of the plane
+        valid = np.flatnonzero((depth > 1e-9) & (cx >= 0) & (cx < size) & (cy >= 0) & (cy < size))
+        cells = cy[valid].astype(np.int64) * size + cx[valid].astype(np.int64)
+        starts = grid['offsets'][cells]
+        counts = grid['offsets'][cells + 1] - starts
+        point_ids = np.repeat(valid, counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return point_ids, grid['triangles'][np.repeat(starts, counts) + local]
+
+    def __intersect(self, origin, directions, triangle_ids):
+        """ Moller-Trumbore for rays from origin, returns (hit, distance along the unit direction) """
+        e1, e2 = self.e1[triangle_ids], self.e2[triangle_ids]
+        tvec = origin - self.v0[triangle_ids]
+        pvec = np.cross(directions, e2)
+        det = np.einsum('ij,ij->i', e1, pvec)
+        valid = np.abs(det) > 1e-12
+        inv = 1. / np.where(valid, det, 1.)
+        u = np.einsum('ij,ij->i', tvec, pvec) * inv
+        qvec = np.cross(tvec, e1)
+        v = np.einsum('ij,ij->i', directions, qvec) * inv
+        t = np.einsum('ij,ij->i', e2, qvec) * inv
+        hit = valid & (u >= 0) & (v >= 0) & (u + v <= 1) & (t > 1e-9)
+        return hit, t
+
+
+_worker = {}
+
+
+def _init_worker(engine, origin):
+    _worker['engine'] = engine
+    _worker['origin'] = origin
+
+
+def _label_worker(points):
+    return _worker['engine'].label(points, _worker['origin'])
@@ -0,0 +1,97 @@
+import os
+import json
+import numpy as np
+
+
+class OccupancyWriter:
+    """
+    Appends the occupancy samples of a run to one file: per sample the camera frame coordinates as a (k, 3)
+    float16 / float32 block followed by the occupancy bits (np.packbits). <path>.jsonl indexes every sample with
+    its byte offset, so single samples can be read back directly (see OccupancyReader).
+
+    An index line is only written once its data is on disk. Opening an existing file keeps its indexed samples
+    (listed in samples, a resumed run skips them) and cuts off the bytes of a crashed write. Sample ids are
+    unique, writing one that is already in the file raises.
+    """
+    def __init__(self, path, dtype='float16'):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        folder = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.samples = set()
+        end = 0
+        if os.path.exists(path + '.jsonl'):
+            reader = OccupancyReader(path)
+            self.samples = set(reader.records)
+            end = max([reader.end(sample) for sample in self.samples] + [0])
+        self.data = open(path, 'ab')
+        self.data.truncate(end)
+        self.index = open(path + '.jsonl', 'a')
+        ## a torn last line of a crashed run must not swallow the next record
+        if self.index.tell() > 0:
+            with open(path + '.jsonl', 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self.index.write('\n')
+
+    def write(self, sample, points, occupied):
+        if sample in self.samples:
+            raise RuntimeError('sample {} is already in {}'.format(sample, self.path))
+        points = np.ascontiguousarray(points, dtype=self.dtype)
+        bits = np.packbits(np.asarray(occupied, dtype=bool))
+        offset = self.data.seek(0, os.SEEK_END)
+        self.data.write(points.tobytes())
+        self.data.write(bits.tobytes())
+        self.data.flush()
+        os.fsync(self.data.fileno())
+        record = {'sample': int(sample), 'offset': offset, 'count': len(points), 'dtype': self.dtype.name}
+        self.index.write(json.dumps(record) + '\n')
+        self.index.flush()
+        self.samples.add(int(sample))
+        return record
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+
+class OccupancyReader:
+    """ samples of a file written by OccupancyWriter """
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        with open(path + '.jsonl') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                self.records[record['sample']] = record
+
+    def __len__(self):
+        return len(self.records)
+
+    def samples(self):
+        return sorted(self.records)
+
+    def end(self, sample):
+        """ byte offset just after a sample """
+        record = self.records[sample]
+        count = record['count']
+        return record['offset'] + count * 3 * np.dtype(record['dtype']).itemsize + (count + 7) // 8
+
+    def read(self, sample):
+        """ (points (k, 3), occupied (k,) bool) of a sample """
+        record = self.records[sample]
+        count, dtype = record['count'], np.dtype(record['dtype'])
+        with open(self.path, 'rb') as f:
+            f.seek(record['offset'])
+            points = np.frombuffer(f.read(count * 3 * dtype.itemsize), dtype=dtype).reshape(count, 3)
+            bits = np.frombuffer(f.read((count + 7) // 8), dtype=np.uint8)
+        return points, np.unpackbits(bits)[:count].astype(bool)
+
+    def array(self, sample):
+        """ the (k, 4) [x, y, z, occupied] float array of the per sample .npy files """
+        points, occupied = self.read(sample)
+        return np.hstack([points.astype(np.float64), occupied[:, np.newaxis].astype(np.float64)])
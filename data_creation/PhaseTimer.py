@@ -0,0 +1,54 @@
+import json
+import time
+import contextlib
+from collections import OrderedDict
+
+
+class PhaseTimer:
+    """
+    Collects wall times per named phase (e.g. 'load', 'render.composite') and compares them with a stored
+    baseline report.
+    """
+    def __init__(self):
+        self.times = OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times.setdefault(name, []).append(time.perf_counter() - start)
+
+    def summary(self):
+        summary = OrderedDict()
+        for name, times in self.times.items():
+            ordered = sorted(times)
+            summary[name] = {'count': len(times), 'total': sum(times), 'mean': sum(times) / len(times),
+                             'median': ordered[len(ordered) // 2], 'min': ordered[0], 'max': ordered[-1]}
+        return summary
+
+    def save(self, path, **meta):
+        report = {'meta': meta, 'phases': self.summary()}
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        return report
+
+    def compare(self, baseline, tolerance=0.1, min_seconds=0.005):
+        """
+        Phases whose median got slower than the baseline report by more than tolerance (as a fraction).
+        Phases faster than min_seconds in both runs are too noisy to judge and are skipped.
+        Returns a list of (phase, baseline median, median).
+        """
+        regressions = []
+        phases = baseline['phases']
+        for name, stats in self.summary().items():
+            if name not in phases:
+                continue
+            before = phases[name]['median']
+            now = stats['median']
+            if max(before, now) < min_seconds:
+                continue
+            if now > before * (1 + tolerance):
+                regressions.append((name, before, now))
+        return regressions
@@ -0,0 +1,39 @@
+import os
+import json
+import hashlib
+import bpy
+
+
+class SceneTemplate:
+    """
+    The scene that BlenderRender, IntrinsicRender and render.py build (camera and constraints, sun, world,
+    compositor nodes, reference sphere) saved as a .blend, so later runs open it instead of building it again.
+
+    The file name carries a version: a hash of the setup code (the modules in SOURCES, the scripts only call
+    their setup methods) and of the settings the scene was built with. Changing either makes a new template, old ones are simply never opened again.
+    """
+    SOURCES = ['BlenderRender.py', 'IntrinsicRender.py', 'SceneTemplate.py']
+
+    def __init__(self, folder, **settings):
+        self.folder = folder
+        md5 = hashlib.md5(json.dumps(settings, sort_keys=True).encode('utf-8'))
+        here = os.path.dirname(os.path.realpath(__file__))
+        for source in self.SOURCES:
+            with open(os.path.join(here, source), 'rb') as f:
+                md5.update(f.read())
+        self.version = md5.hexdigest()[:12]
+        self.path = os.path.join(folder, 'scene_' + self.version + '.blend')
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def open(self):
+        bpy.ops.wm.open_mainfile(filepath=self.path)
+
+    def save(self):
+        """ write the current scene as the template, moved in place so concurrent workers never open half a file """
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        tmp_path = os.path.join(self.folder, 'scene_{}.{}.tmp.blend'.format(self.version, os.getpid()))
+        bpy.ops.wm.save_as_mainfile(filepath=tmp_path, copy=True)
+        os.replace(tmp_path, self.path)
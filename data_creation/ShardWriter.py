@@ -0,0 +1,132 @@
+import os
+import io
+import json
+import tarfile
+
+
+class ShardWriter:
+    """
+    Groups the outputs of a sample into one record and streams records into tar shards of
+    samples_per_shard records each. Members are named <index>.<mode>.<extension>, so the shards also read as
+    webdataset-style tars, and index.jsonl maps every sample to its shard and the byte offset / size of each
+    member for direct reads (see ShardReader).
+
+    A shard is written as shard-<first index>.tar.part and only renamed and indexed once it is full (or on
+    close), so a crash never leaves a half written shard in the index. Records given as file paths are deleted
+    once their shard is safely on disk; until then they can be re-added after a restart.
+    """
+    INDEX = 'index.jsonl'
+
+    def __init__(self, root, samples_per_shard=1000):
+        self.root = root
+        self.samples_per_shard = samples_per_shard
+        if not os.path.exists(root):
+            os.makedirs(root)
+        self.archived = set()
+        index_path = os.path.join(root, self.INDEX)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                for line in f:
+                    try:
+                        self.archived.add(json.loads(line)['index'])
+                    except ValueError:
+                        continue
+        ## leftovers of a crashed run, their samples are not in the index
+        for name in os.listdir(root):
+            if name.endswith('.tar.part'):
+                os.remove(os.path.join(root, name))
+        self.tar = None
+        self.pending = set()
+
+    def __open(self, index):
+        self.name = 'shard-{:09d}.tar'.format(index)
+        self.tar = tarfile.open(os.path.join(self.root, self.name + '.part'), 'w', format=tarfile.USTAR_FORMAT)
+        self.records = []
+        self.staged = []
+        self.pending = set()
+
+    def add(self, index, files):
+        """ files: {mode: path of a rendered file} or {mode.extension: encoded bytes} """
+        if index in self.archived or index in self.pending:
+            return
+        if self.tar is None:
+            self.__open(index)
+        members = {}
+        for mode, data in sorted(files.items()):
+            if isinstance(data, bytes):
+                mode, extension = mode.rsplit('.', 1)
+            else:
+                extension = data.rsplit('.', 1)[-1]
+                self.staged.append(data)
+                with open(data, 'rb') as f:
+                    data = f.read()
+            info = tarfile.TarInfo('{}.{}.{}'.format(index, mode, extension))
+            info.size = len(data)
+            ## ustar headers are one block, the member data follows right after it
+            offset = self.tar.offset + tarfile.BLOCKSIZE
+            self.tar.addfile(info, io.BytesIO(data))
+            members[mode] = [offset, len(data), extension]
+        self.records.append({'index': int(index), 'shard': self.name, 'members': members})
+        self.pending.add(index)
+        if len(self.records) >= self.samples_per_shard:
+            self.flush()
+
+    def flush(self):
+        """ close the current shard, move it in place, index its records and drop the staged files """
+        if self.tar is None:
+            return
+        self.tar.close()
+        path = os.path.join(self.root, self.name)
+        with open(path + '.part', 'rb+') as f:
+            os.fsync(f.fileno())
+        os.replace(path + '.part', path)
+        with open(os.path.join(self.root, self.INDEX), 'a') as f:
+            for record in self.records:
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        for record in self.records:
+            self.archived.add(record['index'])
+        for staged in self.staged:
+            if os.path.exists(staged):
+                os.remove(staged)
+        self.tar = None
+        self.pending = set()
+
+    def close(self):
+        self.flush()
+
+
+class ShardReader:
+    """ random access to the records of a folder written by ShardWriter """
+    def __init__(self, root):
+        self.root = root
+        self.records = {}
+        with open(os.path.join(root, ShardWriter.INDEX)) as f:
+            for line in f:
+                record = json.loads(line)
+                self.records[record['index']] = record
+
+    def __len__(self):
+        return len(self.records)
+
+    def indices(self):
+        return sorted(self.records)
+
+    def read(self, index, mode):
+        """ encoded bytes of one output of a sample """
+        record = self.records[index]
+        offset, size, _ = record['members'][mode]
+        with open(os.path.join(self.root, record['shard']), 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def sample(self, index):
+        """ {mode: bytes} of all outputs of a sample, read in one pass over its (contiguous) members """
+        record = self.records[index]
+        with open(os.path.join(self.root, record['shard']), 'rb') as f:
+            out = {}
+            for mode, (offset, size, _) in sorted(record['members'].items(), key=lambda item: item[1][0]):
+                f.seek(offset)
+                out[mode] = f.read(size)
+            return out
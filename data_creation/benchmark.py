@@ -0,0 +1,136 @@
+import sys, argparse
+
+################################
+############ Setup #############
+################################
+## blender --background -noaudio --python benchmark.py -- --include .. --baseline benchmarks/baseline.json
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--gpu', default=True, type=bool, help='gpu-enabled rendering')
+parser.add_argument('--output', default='output/benchmark/', type=str, help='save directory for the rendered images')
+parser.add_argument('--dem_root_path', default='tiff_files/dems/', type=str, help='root_dir for dems')
+parser.add_argument('--tex_root_path', default='tiff_files/texs/', type=str, help='rood_dir for textures')
+parser.add_argument('--dem_index', default=0, type=int, help='dem that is benchmarked')
+parser.add_argument('--x_res', default=512, type=int, help='x resolution')
+parser.add_argument('--y_res', default=512, type=int, help='x resolution')
+parser.add_argument('--start', default=0, type=int, help='first row of the parameter slice')
+parser.add_argument('--finish', default=4, type=int, help='end of the parameter slice')
+parser.add_argument('--array_path', default='arrays/shader.npy', type=str, help='path to array of lighting parameters')
+parser.add_argument('--include', default='.', type=str, help='directory to include in python path')
+parser.add_argument('--lod', action='store_true', help='resample dem meshes to the output pixel density')
+parser.add_argument('--lod_error', default=0.1, type=float, help='largest height error (m) of the --lod resampling')
+parser.add_argument('--profile', action='append', default=[],
+                    help='render profile of a mode as mode=engine,samples,max_bounces,resolution_percentage '
+                         '(e.g. mask=CYCLES,1,0,100), may be repeated')
+parser.add_argument('--template', default='', type=str, help='folder of prebuilt scene .blend files (see render.py)')
+parser.add_argument('--modes', default='composite,albedo,depth,normals,shading,mask,specular,lights', type=str,
+                    help='comma separated modes rendered per sample (passes: single render of all passes)')
+parser.add_argument('--report', default='output/benchmark/report.json', type=str, help='json report of this run')
+parser.add_argument('--baseline', default='', type=str, help='report to compare against (empty: no comparison)')
+parser.add_argument('--save_baseline', default='', type=str, help='also store this run as a baseline report')
+parser.add_argument('--tolerance', default=0.1, type=float, help='allowed slowdown of a phase median (fraction)')
+
+cmd = sys.argv
+args = cmd[cmd.index('--') + 1:]
+args = parser.parse_args(args)
+sys.path.append(args.include)
+
+import os, json, time
+import bpy
+from data_creation import BlenderRender, DEMRender, IntrinsicRender, SceneTemplate, utils, PhaseTimer, make_arrays
+
+if not os.path.exists(args.output):
+    os.makedirs(args.output)
+modes = args.modes.split(',')
+timer = PhaseTimer.PhaseTimer()
+start_time = time.time()
+
+################################
+########## Benchmark ###########
+################################
+
+with timer.phase('setup'):
+    lod_density = max(args.x_res, args.y_res) / 256. if args.lod else 0
+    loader = DEMRender.DEMRender(args.dem_root_path, args.tex_root_path, lod_density=lod_density,
+                                 lod_error=args.lod_error)
+    template = None
+    if args.template:
+        template = SceneTemplate.SceneTemplate(args.template, gpu=args.gpu, x_res=args.x_res, y_res=args.y_res,
+                                               multilayer=False)
+    setup = template is None or not template.exists()
+    if not setup:
+        template.open()
+    blender = BlenderRender.BlenderRender(args.gpu, setup=setup)
+    intrinsic = IntrinsicRender.IntrinsicRender(args.x_res, args.y_res, profiles=utils.parse_profiles(args.profile),
+                                                setup=setup)
+    if setup:
+        blender.referenceSphere()
+        if template is not None:
+            template.save()
+movement_params = make_arrays.load_params(args.array_path, args.start, args.finish)
+
+with timer.phase('load'):
+    loader.load(args.dem_index)
+with timer.phase('duplicate'):
+    blender.duplicate('shape', 'shape_shading', linked=True)
+    blender.duplicate('shape', 'shape_normals', linked=True)
+
+for ind, movement_param in enumerate(movement_params):
+    count = args.start + ind
+    with timer.phase('place'):
+        blender.translate(['Camera'], list(128.0 * movement_param['camera_dir']))
+        blender.rotate(['Sun'], [0.0] + list(movement_param['sun_phi_theta']))
+        energy, sun_size = movement_param['sun_energy'], movement_param['sun_size']
+        blender.sun(energy, sun_size)
+        blender.rotate(['shape', 'shape_shading', 'shape_normals'], [0.0, 0.0, movement_param['dsm_theta']])
+
+    for mode in modes:
+        filename = str(count) + '_' + mode
+        ## same lighting switch as render.py
+        if mode == 'albedo':
+            blender.world_lighting(2.0)
+            blender.sun(0.0, sun_size)
+        with timer.phase('changeMode.' + mode):
+            intrinsic.changeMode(mode)
+            if mode == 'passes':
+                intrinsic.passOutput(args.output, str(count))
+        ## render and write are timed apart, render.py does both in one write_still render
+        with timer.phase('render.' + mode):
+            bpy.ops.render.render()
+        with timer.phase('write.' + mode):
+            bpy.data.images['Render Result'].save_render(os.path.join(args.output, filename + '.png'))
+            if mode == 'passes':
+                intrinsic.collectPasses(args.output, str(count))
+        if mode == 'albedo':
+            blender.world_lighting(0.0)
+            blender.sun(energy, sun_size)
+
+with timer.phase('delete'):
+    blender.delete(lambda x: x.name in ['shape', 'shape_shading', 'shape_normals'])
+end_time = time.time()
+
+################################
+############ Report ############
+################################
+
+samples = len(movement_params)
+meta = {'dem': loader.dem_paths[args.dem_index], 'start': args.start, 'finish': args.finish, 'modes': modes,
+        'resolution': [args.x_res, args.y_res], 'template': template is not None and not setup,
+        'profiles': intrinsic.profiles, 'blender': bpy.app.version_string,
+        'seconds': end_time - start_time, 'samples_per_second': samples / (end_time - start_time)}
+report = timer.save(args.report, **meta)
+if args.save_baseline:
+    timer.save(args.save_baseline, **meta)
+
+for name, stats in report['phases'].items():
+    print('{:<24} n={:<4} median={:.4f}s total={:.3f}s'.format(name, stats['count'], stats['median'], stats['total']))
+print('samples per second: {:.3f}'.format(meta['samples_per_second']))
+
+if args.baseline:
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = timer.compare(baseline, tolerance=args.tolerance)
+    for name, before, now in regressions:
+        print('REGRESSION {}: {:.4f}s -> {:.4f}s ({:+.0%})'.format(name, before, now, now / before - 1))
+    if regressions:
+        sys.exit(1)
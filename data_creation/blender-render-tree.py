@@ -3,6 +3,10 @@
 # See also: https://stackoverflow.com/questions/14982836/rendering-and-saving-images-through-blender-python
 
 import argparse
+import hashlib
+import os
+import sys
+import bmesh
 import bpy
 import math
 import mathutils
@@ -33,67 +37,102 @@ def get_args():
                         help='width and height of (square) rendered image in pixels')
     parser.add_argument('--viz_occupancy', type=bool, default=False,
                         help='render the occupancy points (with the original object hidden) and output to separate file')
+    parser.add_argument('--viz_free', type=bool, default=False,
+                        help='also render the free occupancy points (red) with --viz_occupancy')
     parser.add_argument('-o', '--out', help="output file basename/prefix (no extension)")
+    parser.add_argument('--occupancy_engine', default='numpy', choices=['numpy', 'raycast'],
+                        help='numpy: label all points against the exported mesh at once, raycast: scene.ray_cast per point')
+    parser.add_argument('--occupancy_processes', type=int, default=1,
+                        help='processes labelling batches of occupancy points (numpy engine)')
+    parser.add_argument('--occupancy_batch', type=int, default=65536,
+                        help='occupancy points labelled per batch (numpy engine)')
+    parser.add_argument('--occupancy_pool', type=int, default=0,
+                        help='label this many points once in the world frame (cached next to the input) and draw each view\'s points from them (0: label fresh points per view)')
+    parser.add_argument('--occupancy_format', default='packed', choices=['packed', 'npy'],
+                        help='packed: all samples in one <out>_occupancy.bin (see OccupancyWriter), samples already in it are skipped, npy: one .npy per sample')
+    parser.add_argument('--occupancy_dtype', default='float16', choices=['float16', 'float32'],
+                        help='coordinate type of the packed format. float16 keeps ~3 significant digits, about 0.03 units at typical camera distances, coarser than the 4 decimals of the npy format')
+    parser.add_argument('--include', default='..', help='directory to include in python path')
     parsed_script_args, _ = parser.parse_known_args(script_args)
+    if 0 < parsed_script_args.occupancy_pool < parsed_script_args.k_occupancy_samples:
+        # Every view draws k distinct points from the pool.
+        parser.error('--occupancy_pool has to be at least --k_occupancy_samples')
     return parsed_script_args
 
 
 args = get_args()
+sys.path.append(args.include)
 
+from data_creation.OccupancyEngine import OccupancyEngine
+from data_creation.OccupancyWriter import OccupancyWriter
 
-def render_occupancy_to_file(basepath, hide_model=True):
-    if hide_model:
+
+def render_occupancy_to_file(path, points, occupied, hide_model_objects=True):
+    if hide_model_objects:
         hide_model()
-    show_occupancy_cubes()
-    render_to_file(basepath + '.viz_occupancy.png')
-    hide_occupancy_cubes()
-    if hide_model:
+    show_occupancy_cloud(points, occupied)
+    render_to_file(path)
+    # Removed rather than hidden, so the raycast engine never hits it when labelling the next view.
+    remove_occupancy_cloud()
+    if hide_model_objects:
         show_model()
 
 
 OCC_CUBE_KEY = '_occ'
+OCC_COLORS = {'occupied': np.array([46., 204., 113.]) / 255, 'free': np.array([231., 76., 60.]) / 255}
+occupancy_objects = []
 
 
-def add_occupancy_cubes():
-    for obj in bpy.context.scene.objects.values():
-        if OCC_CUBE_KEY in obj:
-            return
-
-    green = bpy.data.materials.new("green")
-    green.diffuse_color = np.array([46., 204., 113.]) / 255
-    red = bpy.data.materials.new("red")
-    red.diffuse_color = np.array([231., 76., 60.]) / 255
-    for occ_point, is_occ in zip(occ_points, is_occupied):
-        if is_occ:
-            bpy.ops.mesh.primitive_cube_add(view_align=False, radius=0.1, location=occ_point)
-            bpy.context.object.active_material = green if is_occ else red
-            bpy.context.object[OCC_CUBE_KEY] = 1
-
-
-def show_occupancy_cubes():
+def add_occupancy_cloud(points, occupied, radius=0.1):
     """
-    Intelligently adds/generates the cubes if not already added, otherwise sets them to be visible.
+    One vertex cloud per label (occupied / free) with a cube instanced on every vertex (dupli verts), so the
+    scene gains four objects instead of one cube object per point.
     """
-    just_added = False
-    for obj in bpy.context.scene.objects.values():
-        if OCC_CUBE_KEY in obj:
-            break
-    else:
-        add_occupancy_cubes()
-        just_added = True
-
-    if not just_added:
-        for obj in bpy.context.scene.objects.values():
-            if OCC_CUBE_KEY in obj:
-                obj.hide = False
-                obj.hide_render = False
-
-
-def hide_occupancy_cubes():
-    for obj in bpy.context.scene.objects.values():
-        if OCC_CUBE_KEY in obj:
-            obj.hide = True
-            obj.hide_render = True
+    remove_occupancy_cloud()
+    occupied = np.asarray(occupied, dtype=bool)
+    for label, mask in [('occupied', occupied), ('free', ~occupied)]:
+        label_points = np.asarray(points, dtype=np.float32)[mask]
+        mesh = bpy.data.meshes.new('occ_' + label)
+        mesh.vertices.add(len(label_points))
+        mesh.vertices.foreach_set('co', label_points.ravel())
+        mesh.update()
+        cloud = bpy.data.objects.new('occ_' + label, mesh)
+        cloud.dupli_type = 'VERTS'
+
+        bm = bmesh.new()
+        bmesh.ops.create_cube(bm, size=2 * radius)
+        cube_mesh = bpy.data.meshes.new('occ_' + label + '_cube')
+        bm.to_mesh(cube_mesh)
+        bm.free()
+        material = bpy.data.materials.get('occ_' + label) or bpy.data.materials.new('occ_' + label)
+        material.diffuse_color = OCC_COLORS[label]
+        cube_mesh.materials.append(material)
+        cube = bpy.data.objects.new('occ_' + label + '_cube', cube_mesh)
+        cube.parent = cloud
+
+        for obj in [cloud, cube]:
+            obj[OCC_CUBE_KEY] = 1
+            bpy.context.scene.objects.link(obj)
+            occupancy_objects.append(obj)
+
+
+def remove_occupancy_cloud():
+    for obj in occupancy_objects:
+        data = obj.data
+        bpy.data.objects.remove(obj, do_unlink=True)
+        bpy.data.meshes.remove(data)
+    del occupancy_objects[:]
+
+
+def show_occupancy_cloud(points, occupied):
+    """
+    Rebuilds the clouds for the points of this sample. Free points are only shown with --viz_free.
+    """
+    add_occupancy_cloud(points, occupied)
+    for obj in occupancy_objects:
+        visible = args.viz_free or not obj.name.startswith('occ_free')
+        obj.hide = not visible
+        obj.hide_render = not visible
 
 
 def hide_model():
@@ -144,11 +183,42 @@ def import_scene(path):
     return [obj for obj in bpy.context.scene.objects.values() if not obj in old_objs]
 
 
-def export_scene(path, ext='obj'):
+def export_scene(path, ext='obj', objs=None):
     ext = ext.upper()
-    assert ext in ['OBJ']
+    assert ext in ['OBJ', 'NPZ']
     if ext == 'OBJ':
         bpy.ops.export_scene.obj(filepath=path)
+    elif ext == 'NPZ':
+        # World-space triangles of the (visible) mesh objects, as read by OccupancyEngine.load.
+        vertices, faces = mesh_triangles(objs if objs is not None else bpy.context.scene.objects.values())
+        np.savez(path, vertices=vertices, faces=faces)
+
+
+def mesh_triangles(objs):
+    vertices, faces, offset = [], [], 0
+    for obj in objs:
+        if obj.type != 'MESH' or obj.hide_render:
+            continue
+        # Modifiers applied, as scene.ray_cast sees the object.
+        mesh = obj.to_mesh(bpy.context.scene, True, 'RENDER')
+        bm = bmesh.new()
+        bm.from_mesh(mesh)
+        bmesh.ops.triangulate(bm, faces=bm.faces[:])
+        bm.to_mesh(mesh)
+        bm.free()
+        co = np.empty(len(mesh.vertices) * 3, dtype=np.float64)
+        mesh.vertices.foreach_get('co', co)
+        co = co.reshape(-1, 3)
+        matrix = np.array(obj.matrix_world)
+        vertices.append(co.dot(matrix[:3, :3].T) + matrix[:3, 3])
+        tri = np.empty(len(mesh.polygons) * 3, dtype=np.int64)
+        mesh.polygons.foreach_get('vertices', tri)
+        faces.append(tri.reshape(-1, 3) + offset)
+        offset += len(co)
+        bpy.data.meshes.remove(mesh)
+    if not vertices:
+        return np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int64)
+    return np.vstack(vertices), np.vstack(faces)
 
 
 def get_objects_bbox(objs):
@@ -278,6 +348,11 @@ def generate_occupancy_data(bbox_minmax, camera_location):
     # See also: https://blender.stackexchange.com/questions/31693/how-to-find-if-a-point-is-inside-a-mesh
     occ_points = np.random.uniform(size=(args.k_occupancy_samples, 3))
     occ_points = occ_points * bbox_minmax[0] + (1 - occ_points) * bbox_minmax[1]
+    if args.occupancy_engine == 'numpy':
+        # Same occupied logic as the ray casts below, for all points at once (see OccupancyEngine).
+        is_occupied = get_occupancy_engine().label(occ_points, np.array(camera_location), batch=args.occupancy_batch,
+                                             processes=args.occupancy_processes)
+        return occ_points, list(is_occupied)
     is_occupied = []
     occ_origin = mathutils.Vector(camera_location)  # Actually could be any point we know to be outside the model?
     for i, occ_point in enumerate(occ_points):
@@ -303,6 +378,55 @@ def generate_occupancy_data(bbox_minmax, camera_location):
     return occ_points, is_occupied
 
 
+def occupancy_pool_origin(bbox_minmax):
+    # Pool labels cannot depend on a view, the rays start above the bbox center instead of at the camera.
+    bbox_min, bbox_max = np.array(bbox_minmax[0]), np.array(bbox_minmax[1])
+    origin = (bbox_min + bbox_max) / 2
+    origin[2] = bbox_max[2] + np.abs(bbox_max - bbox_min).max()
+    return origin
+
+
+def occupancy_pool_path(bbox_minmax):
+    key = json.dumps([os.path.getmtime(args.input), args.occupancy_pool,
+                      np.round(np.array(bbox_minmax), 6).tolist()])
+    return '{base}_occupancy_pool_{key}.npz'.format(base=os.path.splitext(args.input)[0],
+                                                  key=hashlib.md5(key.encode()).hexdigest()[:10])
+
+
+def load_occupancy_pool(bbox_minmax):
+    """
+    World frame (points, occupied) pool of args.occupancy_pool points, labelled once and cached next to the input
+    model. The cache is keyed on the model's mtime, the pool size and the bbox.
+    """
+    path = occupancy_pool_path(bbox_minmax)
+    if os.path.exists(path):
+        pool = np.load(path)
+        print('Loaded occupancy pool ' + path)
+        return pool['points'], pool['occupied']
+    points = np.random.uniform(size=(args.occupancy_pool, 3))
+    points = points * bbox_minmax[0] + (1 - points) * bbox_minmax[1]
+    occupied = get_occupancy_engine().label(points, occupancy_pool_origin(bbox_minmax), batch=args.occupancy_batch,
+                                            processes=args.occupancy_processes)
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, points=points, occupied=occupied)
+    os.replace(path + '.tmp', path)
+    print('Wrote occupancy pool ' + path)
+    return points, occupied
+
+
+def sample_occupancy_pool(pool):
+    # Per view cost is indexing: k distinct points of the pool.
+    points, occupied = pool
+    indices = np.random.choice(len(points), args.k_occupancy_samples, replace=False)
+    return points[indices], list(occupied[indices])
+
+
+def transform_points(matrix, points):
+    # One matmul for all points instead of a mathutils.Matrix * Vector per point.
+    matrix = np.array(matrix)
+    return np.asarray(points).dot(matrix[:3, :3].T) + matrix[:3, 3]
+
+
 ### Examples of other stuff
 # Access all scene objects:
 # print(list(bpy.context.scene.objects))
@@ -322,17 +446,39 @@ model_objects = import_scene(args.input)
 model_bbox_minmax = get_objects_bbox(model_objects)
 model_bbox_minmax = pad_bbox(*model_bbox_minmax, pad_ratio=args.bbox_pad_ratio)
 
+occupancy_engine = None
+
+
+def get_occupancy_engine():
+    # Export the model once, every view labels its points against the same triangles.
+    global occupancy_engine
+    if occupancy_engine is None:
+        out_mesh = '{prefix}_mesh.npz'.format(prefix=args.out)
+        export_scene(out_mesh, ext='npz', objs=model_objects)
+        occupancy_engine = OccupancyEngine.load(out_mesh)
+        print('Exported {} triangles to {}'.format(len(occupancy_engine), out_mesh))
+    return occupancy_engine
+
+
+if args.occupancy_pool > 0:
+    occupancy_pool = load_occupancy_pool(model_bbox_minmax)
+
 sun = add_sun()
 camera = add_camera()
+if args.occupancy_format == 'packed':
+    out_occupancy = '{prefix}_k{k}_occupancy.bin'.format(prefix=args.out, k=args.k_occupancy_samples)
+    occupancy_writer = OccupancyWriter(out_occupancy, dtype=args.occupancy_dtype)
 
 for n in range(args.n_samples):
+    if args.occupancy_format == 'packed' and n in occupancy_writer.samples:
+        # Finished by an earlier run with the same --out.
+        continue
     sample_basename = '{prefix}_n{n}_k{k}'.format(
         prefix=args.out,
         n=n,
         k=args.k_occupancy_samples,
     )
     out_image = sample_basename + '_render.png'
-    out_occupancy = sample_basename + '_occupancy.npy'
     out_viz_occupancy = sample_basename + '.viz_occupancy.png'
 
     # Random sun and camera locations.
@@ -342,38 +488,41 @@ for n in range(args.n_samples):
     point_camera_at_location(camera, bbox_center)
 
     # Transform occupancy point coordinates to camera-centric system.
-    occ_points, is_occ_bools = generate_occupancy_data(model_bbox_minmax, camera.location)
+    if args.occupancy_pool > 0:
+        occ_points, is_occ_bools = sample_occupancy_pool(occupancy_pool)
+    else:
+        occ_points, is_occ_bools = generate_occupancy_data(model_bbox_minmax, camera.location)
     # Results in CRS originating at the center of the camera sensor and oriented with the camera,
     # so that the X axis is "right", the Y axis is "up", and the Z axis is out toward the viewer,
     # and therefore every object in the render has a negative Z axis value.
     # Since the camera is aimed toward the center of the model's bbox, if the camera is D distance
     # from the bbox center, then the bbox center will have the camera-relative coordinates of [0,0,-D].
     camera_crs_transform = camera.matrix_basis.inverted()
-    occ_points_camera_crs = np.array([
-                                         (camera_crs_transform * mathutils.Vector(p))[:]
-                                         for p in occ_points])
+    occ_points_camera_crs = transform_points(camera_crs_transform, occ_points)
 
     # Render image
     render_to_file(out_image)
     print('Wrote ' + out_image)
 
-    # Write occupancy CSV
-    od1 = occ_points_camera_crs.round(4)
-    od2 = np.array(is_occ_bools).astype(int)[:, np.newaxis]
-    print(od1.shape, od2.shape)
-    occupancy_data = np.hstack([
-        od1,
-        od2,
-    ])
-    np.save(out_occupancy, occupancy_data)
-    print('Wrote ' + out_occupancy)
+    # Write occupancy data
+    if args.occupancy_format == 'packed':
+        occupancy_writer.write(n, occ_points_camera_crs, is_occ_bools)
+        print('Appended sample {} to {}'.format(n, out_occupancy))
+    else:
+        out_occupancy_npy = sample_basename + '_occupancy.npy'
+        od1 = occ_points_camera_crs.round(4)
+        od2 = np.array(is_occ_bools).astype(int)[:, np.newaxis]
+        occupancy_data = np.hstack([
+            od1,
+            od2,
+        ])
+        np.save(out_occupancy_npy, occupancy_data)
+        print('Wrote ' + out_occupancy_npy)
 
     # Visualize Occupancy (Optional)
     if args.viz_occupancy:
-        render_occupancy_to_file(out_viz_occupancy)
+        render_occupancy_to_file(out_viz_occupancy, occ_points, is_occ_bools)
         print('Wrote ' + out_viz_occupancy)
 
-
-
-
-
+if args.occupancy_format == 'packed':
+    occupancy_writer.close()
@@ -1,6 +1,8 @@
 import numpy as np
 import argparse
 import math
+import json
+import os
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--sun_energy_size_low', default=[2, 0.01])
@@ -11,22 +13,17 @@ parser.add_argument('--camera_phi_theta_low', default=[0.0, -180.0])
 parser.add_argument('--camera_phi_theta_high', default=[35.0, 180.0])
 parser.add_argument('--dsm_theta_low', default=-180)
 parser.add_argument('--dsm_theta_high', default=180)
-parser.add_argument('--n_repeat', default=200)
-parser.add_argument('--n_images', default=100)
+parser.add_argument('--n_repeat', default=200, type=int)
+parser.add_argument('--n_images', default=100, type=int)
 parser.add_argument('--top_image', default=True,
                     help='this takes a top view of the image first with default sun and lighting')
+parser.add_argument('--seed', default=0, type=int, help='base seed, shard k is generated from (seed, k)')
+parser.add_argument('--shard_size', default=100000, type=int, help='rows generated from one seed')
 parser.add_argument('--save_path', default='arrays/shader.npy')
-args = parser.parse_args()
-
-size = args.n_repeat * args.n_images
 
 #TODO make it so that it takes a shot from above for every turning of the image.
-def random(low, high):
-    if type(high) == list:
-        params = [np.random.uniform(low=low[ind], high=high[ind]) for ind in range(len(high))]
-    else:
-        params = np.random.uniform(low=low, high=high)
-    return params
+def random(rng, low, high, size):
+    return rng.uniform(low=low, high=high, size=(size, len(high)) if type(high) == list else size)
 
 
 def __toRadians(degree):
@@ -34,13 +31,14 @@ def __toRadians(degree):
 
 
 def spherical2Cartesian(phi_theta, rho=1.0):
-    phi, theta = phi_theta
+    """ phi_theta: (n, 2) in degrees -> (n, 5) rows of [x, y, z, phi, theta] """
+    phi, theta = phi_theta[:, 0], phi_theta[:, 1]
     phi_r = __toRadians(phi)
     theta_r = __toRadians(theta)
-    x = rho * math.sin(phi_r) * math.cos(theta_r)
-    y = rho * math.sin(phi_r) * math.sin(theta_r)
-    z = rho * math.cos(phi_r)
-    return [x, y, z, phi, theta]
+    x = rho * np.sin(phi_r) * np.cos(theta_r)
+    y = rho * np.sin(phi_r) * np.sin(theta_r)
+    z = rho * np.cos(phi_r)
+    return np.stack([x, y, z, phi, theta], axis=1)
 
 
 # this will output a list of lists that has arguments
@@ -48,16 +46,118 @@ def spherical2Cartesian(phi_theta, rho=1.0):
 # have a size args.size x 13
 default_top = [0.0, 0.0, 1.0, 0.0, 0.0, 3.0, 0.1, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0]
 
-if args.top_image:
-    params = [spherical2Cartesian(random(args.sun_phi_theta_low, args.sun_phi_theta_high)) + \
-              random(args.sun_energy_size_low, args.sun_energy_size_high) + \
-              spherical2Cartesian(random(args.camera_phi_theta_low, args.camera_phi_theta_high)) + \
-              [random(args.dsm_theta_low, args.dsm_theta_high)] if (i % args.n_repeat != 0) else default_top \
-              for i in range(size)]
-else:
-    params = [spherical2Cartesian(random(args.sun_phi_theta_low, args.sun_phi_theta_high)) + \
-              random(args.sun_energy_size_low, args.sun_energy_size_high) + \
-              spherical2Cartesian(random(args.camera_phi_theta_low, args.camera_phi_theta_high)) + \
-              [random(args.dsm_theta_low, args.dsm_theta_high)] for i in range(size)]
-
-np.save(args.save_path, params)
+
+# named view of the 13 columns, byte compatible with the plain (n, 13) float64 tables
+PARAM_DTYPE = np.dtype([('sun_dir', np.float64, (3,)), ('sun_phi_theta', np.float64, (2,)),
+                        ('sun_energy', np.float64), ('sun_size', np.float64),
+                        ('camera_dir', np.float64, (3,)), ('camera_phi_theta', np.float64, (2,)),
+                        ('dsm_theta', np.float64)])
+PARAM_VERSION = 1
+
+
+def to_structured(params):
+    """ (n, 13) float64 rows -> (n,) PARAM_DTYPE records (a view when params is contiguous) """
+    params = np.ascontiguousarray(params, dtype=np.float64)
+    return params.view(PARAM_DTYPE).reshape(-1)
+
+
+def header_path(path):
+    return os.path.splitext(path)[0] + '.json'
+
+
+def create_params(path, size, settings):
+    """
+    Open a new parameter table for writing: a .npy of PARAM_DTYPE records plus a .json header next to it with
+    the settings it was generated with. Returns the writable memmap as (size, 13) float64.
+    """
+    header = {'version': PARAM_VERSION, 'rows': size, 'fields': PARAM_DTYPE.names,
+              'settings': dict((k, v) for k, v in vars(settings).items() if k != 'save_path')}
+    with open(header_path(path), 'w') as f:
+        json.dump(header, f, indent=2)
+    params = np.lib.format.open_memmap(path, mode='w+', dtype=PARAM_DTYPE, shape=(size,))
+    return params.view(np.float64).reshape(size, 13)
+
+
+def load_header(path):
+    """ generation settings of a table written by create_params, None for tables without a header """
+    if not os.path.exists(header_path(path)):
+        return None
+    with open(header_path(path)) as f:
+        return json.load(f)
+
+
+def load_params(path, start=0, stop=None):
+    """
+    Records [start, stop) of a parameter table, memory mapped so only the rows that are used get read.
+    Old plain (n, 13) tables are viewed as PARAM_DTYPE too.
+    """
+    params = np.load(path, mmap_mode='r')
+    if params.dtype != PARAM_DTYPE:
+        if params.ndim != 2 or params.shape[1] != 13:
+            raise RuntimeError('Unrecognized parameter table {} of shape {}'.format(path, params.shape))
+        params = params.view(PARAM_DTYPE).reshape(-1)
+    return params[start:stop]
+
+
+def run_params(path, start, stop, seed=-1):
+    """
+    Records [start, stop) a render run works on: memory mapped from the table at path, or with seed >= 0 drawn
+    again with the settings in the table's header (the defaults without one) and that seed
+    """
+    if seed < 0:
+        return load_params(path, start, stop)
+    settings = parser.parse_args([])
+    header = load_header(path)
+    if header is not None:
+        vars(settings).update(header['settings'])
+    settings.seed = seed
+    return to_structured(generate(start, stop, settings))
+
+
+def dem_index(row, repeat, n_dems):
+    """ dem a table row is rendered with: the table holds repeat rows per dem and cycles through the dems """
+    return (row // repeat) % n_dems
+
+
+def generate_shard(shard, settings):
+    """ all rows of one shard, drawn from a RandomState seeded with (seed, shard) """
+    rng = np.random.RandomState([settings.seed, shard])
+    start = shard * settings.shard_size
+    n = settings.shard_size
+    params = np.empty((n, 13))
+    params[:, 0:5] = spherical2Cartesian(random(rng, settings.sun_phi_theta_low, settings.sun_phi_theta_high, n))
+    params[:, 5:7] = random(rng, settings.sun_energy_size_low, settings.sun_energy_size_high, n)
+    params[:, 7:12] = spherical2Cartesian(random(rng, settings.camera_phi_theta_low,
+                                                 settings.camera_phi_theta_high, n))
+    params[:, 12] = random(rng, settings.dsm_theta_low, settings.dsm_theta_high, n)
+    if settings.top_image:
+        params[(start + np.arange(n)) % settings.n_repeat == 0] = default_top
+    return params
+
+
+def generate(start, stop, settings=None, out=None):
+    """
+    Rows [start, stop) of the parameter table. Only the shards overlapping the range are drawn, so a worker
+    can regenerate its own slice with the same settings instead of loading the whole table.
+    """
+    if settings is None:
+        settings = parser.parse_args([])
+    if out is None:
+        out = np.empty((stop - start, 13))
+    for shard in range(start // settings.shard_size, -(-stop // settings.shard_size)):
+        shard_start = shard * settings.shard_size
+        low = max(start, shard_start)
+        high = min(stop, shard_start + settings.shard_size)
+        out[low - start:high - start] = generate_shard(shard, settings)[low - shard_start:high - shard_start]
+    return out
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    size = args.n_repeat * args.n_images
+    ## written shard by shard straight into the .npy, so the table never has to fit in memory
+    params = create_params(args.save_path, size, args)
+    for start in range(0, size, args.shard_size):
+        stop = min(start + args.shard_size, size)
+        generate(start, stop, settings=args, out=params[start:stop])
+    params.flush()
@@ -13,13 +13,44 @@ parser.add_argument('--category', default='DEM', type=str,
 parser.add_argument('--dem_root_path', default='tiff_files/dems/', type=str, help='root_dir for dems')
 parser.add_argument('--tex_root_path', default='tiff_files/texs/', type=str, help='rood_dir for textures')
 parser.add_argument('--max_load', default=0, type=int, help='maximum number of dems to use')
+parser.add_argument('--dem_cache', default='', type=str, help='directory for cached dem meshes (empty: no cache)')
 parser.add_argument('--x_res', default=512, type=int, help='x resolution')
 parser.add_argument('--y_res', default=512, type=int, help='x resolution')
 parser.add_argument('--start', default=0, type=int, help='min image index')
 parser.add_argument('--finish', default=10, type=int, help='max image index')
 parser.add_argument('--array_path', default='arrays/shader.npy', type=str, help='path to array of lighting parameters')
 parser.add_argument('--include', default='.', type=str, help='directory to include in python path')
+parser.add_argument('--lod', action='store_true', help='resample dem meshes to the output pixel density')
+parser.add_argument('--lod_error', default=0.1, type=float, help='largest height error (m) of the --lod resampling')
+parser.add_argument('--profile', action='append', default=[],
+                    help='render profile of a mode as mode=engine,samples,max_bounces,resolution_percentage '
+                         '(e.g. mask=CYCLES,1,0,100), may be repeated')
 parser.add_argument('--repeat', default=10, type=int, help='number of renderings per object')
+parser.add_argument('--array_seed', default=-1, type=int,
+                    help='regenerate this run\'s rows with make_arrays and this seed instead of loading array_path')
+parser.add_argument('--multipass', action='store_true',
+                    help='render composite, albedo, depth, normals, shading, mask and specular in one render')
+parser.add_argument('--multilayer', action='store_true', help='write the --multipass passes as one multilayer exr')
+parser.add_argument('--base_manifest', action='append', default=[],
+                    help='manifest of earlier output whose finished samples are skipped too (--layout files), may be repeated')
+parser.add_argument('--verify', action='store_true', help='check manifest checksums before skipping finished files')
+parser.add_argument('--layout', default='files', choices=['files', 'tar'],
+                    help='one file per output, or one record per sample in tar shards with an index')
+parser.add_argument('--shard_samples', default=1000, type=int, help='samples per tar shard with --layout tar')
+parser.add_argument('--numpy_passes', action='store_true',
+                    help='compute albedo, depth, normals and mask from the dem with NumpyRender instead of blender')
+parser.add_argument('--capture', action='store_true',
+                    help='read frames back from blender and encode / write them on background threads')
+parser.add_argument('--write_threads', default=2, type=int, help='encoding threads with --capture')
+parser.add_argument('--batch', default=0, type=int,
+                    help='samples of an object keyframed and rendered as one animation per mode (0: a render per sample)')
+parser.add_argument('--template', default='', type=str,
+                    help='folder of prebuilt scene .blend files, the scene is opened from there (or saved there once)')
+parser.add_argument('--queue', default='', type=str,
+                    help='serve render jobs from this JobQueue folder after the scene setup, until it is stopped')
+parser.add_argument('--worker_name', default='', type=str, help='name of this worker in the --queue (default: host-pid)')
+parser.add_argument('--poll', default=1.0, type=float, help='seconds between checks of an empty --queue')
+parser.add_argument('--write_queue', default=8, type=int, help='frames waiting for encoding before rendering blocks')
 
 # TODO : look into this for when we may have to call blender
 ## ignore the blender arguments
@@ -39,12 +70,13 @@ print(sys.path)
 ## (e.g., scipy)
 
 ## import everything else
-import os, random  # , math, argparse, scipy.io, scipy.stats, time, subprocess, pdb
+import os, random, functools, traceback  # , math, argparse, scipy.io, scipy.stats, time, subprocess, pdb
 import numpy as np
 import bpy
 import time
 ## import repo modules
-from data_creation import BlenderRender, DEMRender, IntrinsicRender
+from data_creation import BlenderRender, DEMRender, IntrinsicRender, utils, FrameWriter, Manifest, ShardWriter, make_arrays
+from data_creation import NumpyRender, JobQueue, SceneTemplate
 
 # from dataset.BlenderShapenet import BlenderRender, ShapenetRender, IntrinsicRender
 # from dataset.PrimitiveRender import PrimitiveRender
@@ -56,84 +88,300 @@ from data_creation import BlenderRender, DEMRender, IntrinsicRender
 staging = os.path.join(args.staging, str(random.random()))
 
 ## choose a renderer based on category
-loader = DEMRender.DEMRender(args.dem_root_path, args.tex_root_path, max_load=args.max_load)
+## output pixels per world unit for --lod, the camera of BlenderRender frames ortho_scale (256) units
+lod_density = max(args.x_res, args.y_res) / 256. if args.lod else 0
+loader = DEMRender.DEMRender(args.dem_root_path, args.tex_root_path, max_load=args.max_load,
+                             cache_dir=args.dem_cache or None, lod_density=lod_density, lod_error=args.lod_error)
 # we do this before blenderrender because we neeed to initialize the camera
 
 ################################
 ########## Rendering ###########
 ################################
 
+## with --template the scene set up below is opened from a .blend saved by an earlier run with the same setup
+## code and settings, instead of being built object by object
+template = None
+if args.template:
+    template = SceneTemplate.SceneTemplate(args.template, gpu=args.gpu, x_res=args.x_res, y_res=args.y_res,
+                                           multilayer=args.multilayer)
+setup = template is None or not template.exists()
+if not setup:
+    template.open()
+
 ## standard blender operations
-blender = BlenderRender.BlenderRender(args.gpu)
+blender = BlenderRender.BlenderRender(args.gpu, setup=setup)
 
 ## rendering intrinsic images along with composite object
-intrinsic = IntrinsicRender.IntrinsicRender(args.x_res, args.y_res)
-
-## load light array created with make_array.py
-movement_params = np.load(args.array_path)
-
-blender.sphere([0, 0, 0], 100, label='sphere')
-
-count = args.start
-start_time = time.time()
-while count < args.finish:
-
-    ## load a new object from the category
-    ## and copy it for shading / shape renderings
-    loader.load(count)
-    blender.duplicate('shape', 'shape_shading')
-    blender.duplicate('shape', 'shape_normals')
-
-    ## render it args.repeat times in different positions and orientations
-    rep_time =time.time()
-    for rep in range(args.repeat):
-        movement_param = movement_params[count]
-        sun_euler = [0.0] + list(movement_param[3:5])
-        sun_light_size = list(movement_param[5:7])
-        camera_loc = list(128.0 * movement_param[7:10])
-        dsm_euler = [0.0, 0.0] + [movement_param[12]]
-        """ print out the parameters for debugging
-        print('movement_param: {}'.format(movement_param))
-        print('sun_euler: {}'.format(sun_euler))
-        print('sun_light_size: {}'.format(sun_light_size))
-        print('camera_loc: {}'.format(camera_loc))
-        print('dsm_euler: {}'.format(dsm_euler))
-        """
+intrinsic = IntrinsicRender.IntrinsicRender(args.x_res, args.y_res, multilayer=args.multilayer,
+                                            profiles=utils.parse_profiles(args.profile), setup=setup)
+
+if setup:
+    blender.referenceSphere()
+    if template is not None:
+        template.save()
+
+modes = ['composite', 'albedo', 'depth', 'normals', 'shading', 'mask', 'specular', 'lights']
+
+## with --numpy_passes the geometric passes come straight from the dem / texture rasters, blender only
+## renders the lighting dependent modes
+GEOMETRY_MODES = ['albedo', 'depth', 'normals', 'mask']
+geometry = None
+if args.numpy_passes:
+    geometry = NumpyRender.NumpyRender(args.dem_root_path, args.tex_root_path, x_res=args.x_res, y_res=args.y_res,
+                                       ortho_scale=blender.ortho_scale, max_load=args.max_load)
+
+
+def run(args):
+    """ render the samples [args.start, args.finish) into args.output """
+    ## memory map the rows of this run from the light array created with make_array.py,
+    ## or draw them again with the settings in its header
+    movement_params = make_arrays.run_params(args.array_path, args.start, args.finish, args.array_seed)
 
-        ## get position, orientation, and scale uniformly at random based on high / low from arguments
-        # change the camera. This should still be pointing at (0,0,0) because of the constraints
-
-        blender.translate(['Camera'], camera_loc)
-        # this will rotate the sun angle (we use rotation not position because of the way blender does sun
-        blender.rotate(['Sun'], sun_euler)
-        # change the size and emission of the sun
-        energy, sun_size = sun_light_size
-        blender.sun(energy, sun_size)
-        # Rotate the shape
-        blender.rotate(['shape', 'shape_shading', 'shape_normals'],
-                       dsm_euler)
-        ## render the composite image and intrinsic images
-        for mode in ['composite', 'albedo', 'depth', 'normals', 'shading', 'mask', 'specular', 'lights']:
-            filename = str(count) + '_' + mode
-            ## This is added because world lighting should be used with no sun lighting for albedo
-            if mode=='albedo':
+    if args.batch and (args.multipass or args.capture):
+        raise RuntimeError('--batch renders straight to files, it does not work with --multipass or --capture')
+
+    ## every finished file is logged in the manifest, so a restarted run only renders what is missing
+    manifest = Manifest.Manifest(os.path.join(args.output, Manifest.Manifest.NAME), verify=args.verify,
+                                 base=args.base_manifest if args.layout == 'files' else ())
+    if args.multipass and args.multilayer:
+        sample_modes = ['composite', 'passes', 'lights']
+    else:
+        sample_modes = modes
+    ## with --layout tar the files of a sample are staged in args.output until their shard is written
+    writer = ShardWriter.ShardWriter(args.output, args.shard_samples) if args.layout == 'tar' else None
+
+    ## with --capture frames are encoded and written by background threads while the next mode renders
+    frames = FrameWriter.FrameWriter(args.write_threads, args.write_queue) if args.capture else None
+
+    def output(index, mode):
+        """ render the current mode to index_mode.png, it is logged in the manifest once it is on disk """
+        filename = str(index) + '_' + mode
+        if frames is None:
+            blender.write(args.output, filename)
+            manifest.record(index, mode, os.path.join(args.output, filename + '.png'))
+        else:
+            frames.submit(os.path.join(args.output, filename + '.png'), blender.capture(),
+                          done=functools.partial(manifest.record, index, mode))
+
+    def sample_files(index):
+        return dict((mode, os.path.join(args.output, str(index) + '_' + mode + ('.exr' if mode == 'passes' else '.png')))
+                    for mode in sample_modes)
+
+    def skip(index):
+        """ whether a sample finished in an earlier run, complete samples that were not archived yet are now """
+        if writer is not None and index in writer.archived:
+            return True
+        if not manifest.finished([index], sample_modes):
+            return False
+        if writer is not None:
+            writer.add(index, sample_files(index))
+        return True
+
+    def sweep(indices):
+        """
+        Render the samples in indices (of the loaded object) as the frames 1..n of one animation per mode,
+        instead of setting the scene up and rendering once per sample and mode
+        """
+        params = movement_params[np.asarray(indices) - args.start]
+        n = len(indices)
+        camera_locs = 128.0 * params['camera_dir']
+        sun_eulers = np.column_stack([np.zeros(n), params['sun_phi_theta']])
+        dsm_eulers = np.column_stack([np.zeros((n, 2)), params['dsm_theta']])
+        animated = blender.sweep(camera_locs, sun_eulers, params['sun_energy'], params['sun_size'], dsm_eulers,
+                                 ['shape', 'shape_shading', 'shape_normals'])
+        render_modes = modes
+        if geometry is not None:
+            render_modes = [mode for mode in modes if mode not in GEOMETRY_MODES]
+            for index, camera_loc, dsm_euler in zip(indices, camera_locs, dsm_eulers):
+                if manifest.finished([index], GEOMETRY_MODES):
+                    continue
+                geometry.translate(list(camera_loc))
+                geometry.rotate(list(dsm_euler))
+                for mode, image in geometry.geometry().items():
+                    path = os.path.join(args.output, str(index) + '_' + mode + '.png')
+                    utils.write_png(path, image)
+                    manifest.record(index, mode, path)
+        for mode in render_modes:
+            ## frames that are done already are rendered again, one animation is cheaper than splitting it
+            if manifest.finished(indices, [mode]):
+                continue
+            ## world lighting and no sun for albedo, the sun energy is animated so it is keyed to 0 instead
+            if mode == 'albedo':
                 blender.world_lighting(2.0)
-                blender.sun(0.0, sun_size)
-                intrinsic.changeMode(mode)
-                blender.write(args.output, filename)
+                blender.sunKeyframes(np.zeros(n), params['sun_size'])
+            intrinsic.changeMode(mode)
+            paths = blender.writeAnimation(args.output, mode, indices)
+            if mode == 'albedo':
                 blender.world_lighting(0.0)
-                blender.sun(energy, sun_size)
+                blender.sunKeyframes(params['sun_energy'], params['sun_size'])
+            for index, path in zip(indices, paths):
+                manifest.record(index, mode, path)
+        blender.clearKeyframes(animated)
+        if writer is not None:
+            for index in indices:
+                writer.add(index, sample_files(index))
+
+    ## closed on every exit, a long-lived --queue worker runs many jobs and some of them fail
+    completed = False
+    try:
+        count = args.start
+        start_time = time.time()
+        rep_time = end_rep = start_time
+        while count < args.finish:
+
+            if all([skip(index) for index in range(count, min(count + args.repeat, args.finish))]):
+                count += args.repeat
+                continue
+
+            ## load a new object from the category
+            ## and copy it for shading / shape renderings
+            ## make_arrays.py lays out n_repeat rows per dem, the same rows pick the same dem in render_numpy.py
+            dem_index = make_arrays.dem_index(count, args.repeat, len(loader.dem_paths))
+            loader.load(dem_index)
+            if geometry is not None:
+                geometry.load(dem_index)
+            blender.duplicate('shape', 'shape_shading', linked=True)
+            blender.duplicate('shape', 'shape_normals', linked=True)
+
+            ## render it args.repeat times in different positions and orientations
+            rep_time =time.time()
+            if args.batch:
+                block = [index for index in range(count, min(count + args.repeat, args.finish)) if not skip(index)]
+                for low in range(0, len(block), args.batch):
+                    sweep(block[low:low + args.batch])
+                count = min(count + args.repeat, args.finish)
             else:
-                intrinsic.changeMode(mode)
-                blender.write(args.output, filename)
-        count += 1
-    end_rep = time.time()
-    ## delete object
-    blender.delete(lambda x: x.name in ['shape', 'shape_shading', 'shape_normals'])
-end_time = time.time()
-
-print('rep time: {}'.format(end_rep-rep_time))
-print('end time: {}'.format(end_time-start_time))
+                for rep in range(args.repeat):
+                    if count >= args.finish:
+                        break
+                    if skip(count):
+                        count += 1
+                        continue
+                    movement_param = movement_params[count - args.start]
+                    sun_euler = [0.0] + list(movement_param['sun_phi_theta'])
+                    sun_light_size = [movement_param['sun_energy'], movement_param['sun_size']]
+                    camera_loc = list(128.0 * movement_param['camera_dir'])
+                    dsm_euler = [0.0, 0.0] + [movement_param['dsm_theta']]
+                    """ print out the parameters for debugging
+                    print('movement_param: {}'.format(movement_param))
+                    print('sun_euler: {}'.format(sun_euler))
+                    print('sun_light_size: {}'.format(sun_light_size))
+                    print('camera_loc: {}'.format(camera_loc))
+                    print('dsm_euler: {}'.format(dsm_euler))
+                    """
+
+                    ## get position, orientation, and scale uniformly at random based on high / low from arguments
+                    # change the camera. This should still be pointing at (0,0,0) because of the constraints
+
+                    blender.translate(['Camera'], camera_loc)
+                    # this will rotate the sun angle (we use rotation not position because of the way blender does sun
+                    blender.rotate(['Sun'], sun_euler)
+                    # change the size and emission of the sun
+                    energy, sun_size = sun_light_size
+                    blender.sun(energy, sun_size)
+                    # Rotate the shape
+                    blender.rotate(['shape', 'shape_shading', 'shape_normals'],
+                                   dsm_euler)
+                    ## render the composite image and intrinsic images
+                    render_modes = modes
+                    if args.multipass:
+                        ## one render for the composite and every pass the compositor can split out of it,
+                        ## only the lights (sphere instead of the shape) need their own scene setup
+                        pass_modes = ['passes'] if args.multilayer else intrinsic.PASS_MODES
+                        extension = 'exr' if args.multilayer else 'png'
+                        if not manifest.finished([count], ['composite'] + pass_modes):
+                            intrinsic.changeMode('passes')
+                            intrinsic.passOutput(args.output, str(count))
+                            output(count, 'composite')
+                            intrinsic.collectPasses(args.output, str(count))
+                            for mode in pass_modes:
+                                manifest.record(count, mode, os.path.join(args.output, str(count) + '_' + mode + '.' + extension))
+                        render_modes = [mode for mode in modes if mode != 'composite' and mode not in intrinsic.PASS_MODES]
+                    elif geometry is not None:
+                        render_modes = [mode for mode in modes if mode not in GEOMETRY_MODES]
+                        if not manifest.finished([count], GEOMETRY_MODES):
+                            geometry.translate(camera_loc)
+                            geometry.rotate(dsm_euler)
+                            for mode, image in geometry.geometry().items():
+                                path = os.path.join(args.output, str(count) + '_' + mode + '.png')
+                                utils.write_png(path, image)
+                                manifest.record(count, mode, path)
+                    for mode in render_modes:
+                        if manifest.done(count, mode):
+                            continue
+                        ## This is added because world lighting should be used with no sun lighting for albedo
+                        if mode=='albedo':
+                            blender.world_lighting(2.0)
+                            blender.sun(0.0, sun_size)
+                            intrinsic.changeMode(mode)
+                            output(count, mode)
+                            blender.world_lighting(0.0)
+                            blender.sun(energy, sun_size)
+                        else:
+                            intrinsic.changeMode(mode)
+                            output(count, mode)
+                    if writer is not None:
+                        ## the shard reads the files of the sample, so they have to be written first
+                        if frames is not None:
+                            frames.drain()
+                        writer.add(count, sample_files(count))
+                    count += 1
+            end_rep = time.time()
+            ## delete object
+            blender.delete(lambda x: x.name in ['shape', 'shape_shading', 'shape_normals'])
+            print('datablocks: {}'.format(intrinsic.datablocks()))
+        completed = True
+    finally:
+        ## nested, so an encoder error raised by frames.close still closes the manifest and flushes the shard
+        try:
+            if frames is not None:
+                ## the frames still queued by a failed job are dropped, not written into it
+                frames.close(discard=not completed)
+        finally:
+            try:
+                manifest.close()
+            finally:
+                if writer is not None:
+                    writer.close()
+    end_time = time.time()
+
+    print('rep time: {}'.format(end_rep-rep_time))
+    print('end time: {}'.format(end_time-start_time))
+
+
+## fields of the run that a queued job may set, everything else is fixed by the worker's command line
+JOB_FIELDS = ['start', 'finish', 'repeat', 'output', 'array_path', 'array_seed']
+
+
+def serve(root):
+    """ keep the scene that was set up above and render the jobs of a JobQueue until it is stopped """
+    queue = JobQueue.JobQueue(root)
+    worker = args.worker_name or JobQueue.worker_name()
+    print('worker {} serving {}'.format(worker, root))
+    while not queue.stopped():
+        job = queue.claim(worker)
+        if job is None:
+            time.sleep(args.poll)
+            continue
+        job_args = argparse.Namespace(**vars(args))
+        for field in JOB_FIELDS:
+            if field in job:
+                setattr(job_args, field, job[field])
+        try:
+            run(job_args)
+        except Exception as e:
+            traceback.print_exc()
+            ## a failed job can leave its dem behind, the next job loads its own
+            blender.delete(lambda x: x.name in ['shape', 'shape_shading', 'shape_normals'])
+            queue.finish(job, error=repr(e))
+            continue
+        queue.finish(job)
+
+
+if args.queue:
+    serve(args.queue)
+else:
+    run(args)
 
 ################################
 ########## Reference ###########
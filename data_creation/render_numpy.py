@@ -0,0 +1,119 @@
+import os, sys, argparse, time
+
+################################
+############ Setup #############
+################################
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--output', default='output/numpy/', type=str, help='save directory')
+parser.add_argument('--dem_root_path', default='tiff_files/dems/', type=str, help='root_dir for dems')
+parser.add_argument('--tex_root_path', default='tiff_files/texs/', type=str, help='rood_dir for textures')
+parser.add_argument('--max_load', default=0, type=int, help='maximum number of dems to use')
+parser.add_argument('--x_res', default=512, type=int, help='x resolution')
+parser.add_argument('--y_res', default=512, type=int, help='x resolution')
+parser.add_argument('--start', default=0, type=int, help='min image index')
+parser.add_argument('--finish', default=10, type=int, help='max image index')
+parser.add_argument('--array_path', default='arrays/shader.npy', type=str, help='path to array of lighting parameters')
+parser.add_argument('--include', default=os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'), type=str,
+                    help='directory to include in python path')
+parser.add_argument('--repeat', default=10, type=int, help='number of renderings per object')
+parser.add_argument('--array_seed', default=-1, type=int,
+                    help='regenerate this run\'s rows with make_arrays and this seed instead of loading array_path')
+parser.add_argument('--ambient', default=0.0, type=float, help='constant world lighting added to the sun')
+parser.add_argument('--geometry', action='store_true', help='also write the albedo, depth, normals and mask passes')
+parser.add_argument('--horizon_bins', default=0, type=int,
+                    help='look shadows up in a per dem horizon index with this many azimuths (0: march per sample)')
+parser.add_argument('--horizon_cache', default='horizons/', type=str, help='directory of the horizon indices')
+parser.add_argument('--verify', action='store_true', help='check manifest checksums before skipping finished files')
+parser.add_argument('--layout', default='files', choices=['files', 'tar'],
+                    help='one file per output, or one record per sample in tar shards with an index')
+parser.add_argument('--shard_samples', default=1000, type=int, help='samples per tar shard with --layout tar')
+args = parser.parse_args()
+
+sys.path.append(args.include)
+
+from data_creation import HorizonIndex, Manifest, NumpyRender, ShardWriter, make_arrays, utils
+
+if not os.path.exists(args.output):
+    os.makedirs(args.output)
+
+renderer = NumpyRender.NumpyRender(args.dem_root_path, args.tex_root_path, x_res=args.x_res, y_res=args.y_res,
+                                   max_load=args.max_load, ambient=args.ambient)
+
+## memory map the rows of this run from the light array created with make_array.py,
+## or draw them again with the settings in its header
+movement_params = make_arrays.run_params(args.array_path, args.start, args.finish, args.array_seed)
+
+################################
+########## Rendering ###########
+################################
+
+## every finished file is logged in the manifest, so a restarted run only renders what is missing
+manifest = Manifest.Manifest(os.path.join(args.output, Manifest.Manifest.NAME), verify=args.verify)
+modes = ['composite', 'shading', 'shadow']
+if args.geometry:
+    modes += ['albedo', 'depth', 'normals', 'mask']
+## with --layout tar the encoded images go straight into the shards, whose index replaces the manifest
+writer = ShardWriter.ShardWriter(args.output, args.shard_samples) if args.layout == 'tar' else None
+
+
+def skip(index):
+    """ whether a sample finished in an earlier run """
+    if writer is not None:
+        return index in writer.archived
+    return manifest.finished([index], modes)
+
+
+count = args.start
+start_time = time.time()
+rep_time = end_rep = start_time
+while count < args.finish:
+
+    if all(skip(index) for index in range(count, min(count + args.repeat, args.finish))):
+        count += args.repeat
+        continue
+
+    ## make_arrays.py lays out n_repeat rows per dem, so the dem is picked from the row index
+    dem_index = make_arrays.dem_index(count, args.repeat, len(renderer.dem_paths))
+    renderer.load(dem_index)
+    if args.horizon_bins > 0:
+        renderer.horizon_index = HorizonIndex.HorizonIndex.cached(renderer, renderer.dem_paths[dem_index],
+                                                                  args.horizon_cache, args.horizon_bins)
+
+    rep_time = time.time()
+    for rep in range(args.repeat):
+        if count >= args.finish:
+            break
+        if skip(count):
+            count += 1
+            continue
+        movement_param = movement_params[count - args.start]
+        sun_euler = [0.0] + list(movement_param['sun_phi_theta'])
+        sun_light_size = [movement_param['sun_energy'], movement_param['sun_size']]
+        camera_loc = list(128.0 * movement_param['camera_dir'])
+        dsm_euler = [0.0, 0.0] + [movement_param['dsm_theta']]
+
+        renderer.translate(camera_loc)
+        renderer.rotateSun(sun_euler)
+        energy, sun_size = sun_light_size
+        renderer.sun(energy, sun_size)
+        renderer.rotate(dsm_euler)
+
+        ## render the composite, shading and cast shadow images
+        images = renderer.render(geometry=args.geometry)
+        if writer is not None:
+            writer.add(count, dict((mode + '.png', utils.encode_png(images[mode])) for mode in modes))
+        else:
+            for mode in modes:
+                path = os.path.join(args.output, str(count) + '_' + mode + '.png')
+                utils.write_png(path, images[mode])
+                manifest.record(count, mode, path)
+        count += 1
+    end_rep = time.time()
+end_time = time.time()
+manifest.close()
+if writer is not None:
+    writer.close()
+
+print('rep time: {}'.format(end_rep - rep_time))
+print('end time: {}'.format(end_time - start_time))
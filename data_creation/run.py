@@ -1,6 +1,6 @@
 #!/om/user/janner/anaconda2/bin/python
 
-import os, argparse, subprocess
+import os, sys, argparse, subprocess, shutil, time
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--low',        default=0,              type=int, help='min image index')
@@ -9,24 +9,202 @@ parser.add_argument('--repeat',     default=3,              type=int, help='numb
 parser.add_argument('--output',     default='output/car/',  type=str, help='save folder')
 parser.add_argument('--script',     default='render.py',    type=str, help='script run within blender')
 parser.add_argument('--include',    default=None,                     help='directory to include in python path')
+parser.add_argument('--blender',    default='/snap/blender/20/./blender', type=str, help='blender executable')
+parser.add_argument('--workers',    default=1,              type=int, help='number of blender processes run at once')
+parser.add_argument('--threads',    default=0,              type=int, help='render threads per worker (0: all cores)')
+parser.add_argument('--shard_size', default=0,              type=int,
+                    help='image indices per shard, rounded up to a multiple of repeat (0: split evenly over workers)')
+parser.add_argument('--retries',    default=2,              type=int, help='times a failed shard is re-run')
+parser.add_argument('--template',   default='',             type=str,
+                    help='folder of prebuilt scene .blend files passed on to the render script (empty: build the scene)')
+parser.add_argument('--queue',      default='',             type=str,
+                    help='job queue folder: start the workers once and hand them the shards as jobs (empty: one process per shard)')
 args = parser.parse_args()
 
-def render(script, low, high, repeat, output):
+def repo_folder():
     if args.include is None:
         working_dir = os.path.dirname(os.path.realpath(__file__))
-        repo_folder = os.path.join(working_dir, '..')
-    else:
-        repo_folder = args.include
+        return os.path.join(working_dir, '..')
+    return args.include
 
-    command = ['/snap/blender/20/./blender', '--background', '-noaudio', '--python', script, '--', '--include', repo_folder, \
-        '--start', low, '--finish', high, '--repeat', repeat,  '--output', output] #, \
+def template_args():
+    return ['--template', args.template] if args.template else []
 
-    p = subprocess.call(command)
+def base_args(output):
+    ## the shards skip what earlier runs already merged into output (their own folders are gone by then)
+    return ['--base_manifest', os.path.join(output, 'manifest.jsonl')]
 
+## blender exits with 0 when the --python script raises, unless told otherwise (before --python)
+def command(script, low, high, repeat, output, threads=0, base=()):
+    return [args.blender, '--background', '-noaudio', '--threads', str(threads), \
+        '--python-exit-code', '1', '--python', script, '--', \
+        '--include', repo_folder(), '--start', str(low), '--finish', str(high), '--repeat', str(repeat), \
+        '--output', output] + template_args() + list(base)
 
-if __name__ == '__main__':
-    print(args)
-    render(args.script, str(args.low), str(args.high), str(args.repeat), args.output)
+def worker_command(script, queue, name, threads=0, base=()):
+    return [args.blender, '--background', '-noaudio', '--threads', str(threads), \
+        '--python-exit-code', '1', '--python', script, '--', \
+        '--include', repo_folder(), '--queue', queue, '--worker_name', name] + template_args() + list(base)
+
+def render(script, low, high, repeat, output, threads=0):
+    p = subprocess.call(command(script, low, high, repeat, output, threads))
+    return p
+
+def make_shards(low, high, repeat, workers, shard_size=0):
+    """
+    Split [low, high) into (low, high) shards. Shard sizes are a multiple of repeat so that a worker
+    never shares the renderings of one object with another worker.
+    """
+    if shard_size <= 0:
+        shard_size = -(-(high - low) // max(workers, 1))
+    shard_size = max(repeat, -(-shard_size // repeat) * repeat)
+    return [(start, min(start + shard_size, high)) for start in range(low, high, shard_size)]
+
+def shard_output(output, shard):
+    return os.path.join(output, 'shard_{}_{}'.format(*shard))
+
+def merge_shards(output, shards):
+    """ move every file rendered by the shards into output and drop the per-shard folders """
+    for shard in shards:
+        folder = shard_output(output, shard)
+        if not os.path.isdir(folder):
+            continue
+        for name in os.listdir(folder):
+            if name in ['manifest.jsonl', 'index.jsonl']:
+                ## the manifests / tar indices of all shards go into one, paths in them are relative to the folder
+                with open(os.path.join(folder, name)) as src, open(os.path.join(output, name), 'a') as dst:
+                    dst.write(src.read())
+                continue
+            os.replace(os.path.join(folder, name), os.path.join(output, name))
+        shutil.rmtree(folder)
+
+def render_sharded(script, low, high, repeat, output, workers, threads=0, shard_size=0, retries=2):
+    """
+    Run up to `workers` blender processes at once, one per shard, each rendering into its own folder.
+    Shards whose process exits with a non-zero code are queued again (up to `retries` times).
+    Returns the shards that still failed after all retries.
+    """
+    shards = make_shards(low, high, repeat, workers, shard_size)
+    pending = [(shard, 0) for shard in shards]
+    running = {}
+    failed = []
+    while pending or running:
+        while pending and len(running) < workers:
+            shard, attempt = pending.pop(0)
+            folder = shard_output(output, shard)
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            print('starting shard {} (attempt {})'.format(shard, attempt + 1))
+            running[shard] = (subprocess.Popen(command(script, shard[0], shard[1], repeat, folder, threads,
+                                                       base=base_args(output))), attempt)
+
+        for shard, (p, attempt) in list(running.items()):
+            code = p.poll()
+            if code is None:
+                continue
+            del running[shard]
+            if code == 0:
+                print('finished shard {}'.format(shard))
+            elif attempt < retries:
+                print('shard {} exited with {}, retrying'.format(shard, code))
+                pending.append((shard, attempt + 1))
+            else:
+                print('shard {} exited with {}, giving up'.format(shard, code))
+                failed.append(shard)
+        time.sleep(1)
 
+    merge_shards(output, [shard for shard in shards if shard not in failed])
+    return failed
 
+def render_queued(script, low, high, repeat, output, workers, queue_root, threads=0, shard_size=0, retries=2):
+    """
+    Like render_sharded, but the `workers` blender processes are started once and take the shards as jobs from a
+    JobQueue (render.py --queue), so blender startup and scene setup are paid once per worker, not per shard.
+    Workers that die are restarted and their running shard is queued again.
+    """
+    sys.path.append(repo_folder())
+    from data_creation.JobQueue import JobQueue
 
+    queue = JobQueue(queue_root)
+    queue.clearStop()
+    shards = dict(('shard_{}_{}'.format(*shard), shard) for shard in make_shards(low, high, repeat, workers, shard_size))
+    attempts = dict((name, 0) for name in shards)
+    failed = []
+
+    def submit(name):
+        shard = shards[name]
+        folder = shard_output(output, shard)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        queue.remove(name)
+        queue.submit({'start': shard[0], 'finish': shard[1], 'repeat': repeat, 'output': folder}, name)
+
+    def retry(name, reason):
+        attempts[name] += 1
+        if attempts[name] <= retries:
+            print('shard {} {}, retrying'.format(shards[name], reason))
+            submit(name)
+            return True
+        print('shard {} {}, giving up'.format(shards[name], reason))
+        queue.remove(name)
+        failed.append(shards[name])
+        return False
+
+    for name in sorted(shards):
+        submit(name)
+    names = ['worker{}'.format(i) for i in range(workers)]
+    running = dict((name, subprocess.Popen(worker_command(script, queue_root, name, threads, base=base_args(output))))
+                   for name in names)
+    remaining = set(shards)
+    restarts = 0
+    while remaining:
+        for name in sorted(remaining):
+            state = queue.status(name)
+            if state == 'done':
+                print('finished shard {}'.format(shards[name]))
+                remaining.discard(name)
+            elif state == 'failed':
+                if not retry(name, 'failed with {}'.format(queue.result(name)['error'])):
+                    remaining.discard(name)
+        for worker, p in list(running.items()):
+            if p.poll() is None:
+                continue
+            for name in queue.release(worker):
+                if not retry(name, 'lost its worker (exit code {})'.format(p.returncode)):
+                    remaining.discard(name)
+            del running[worker]
+            ## a worker that keeps dying without a job (e.g. a broken blender) is not restarted forever
+            restarts += 1
+            if remaining and restarts <= retries * workers:
+                print('restarting {}'.format(worker))
+                running[worker] = subprocess.Popen(worker_command(script, queue_root, worker, threads,
+                                                                  base=base_args(output)))
+        if not running:
+            print('no workers left')
+            failed.extend(shards[name] for name in remaining)
+            break
+        time.sleep(1)
+
+    queue.stop()
+    for p in running.values():
+        p.wait()
+    merge_shards(output, [shard for shard in shards.values() if shard not in failed])
+    return failed
+
+
+if __name__ == '__main__':
+    print(args)
+    if args.queue:
+        failed = render_queued(args.script, args.low, args.high, args.repeat, args.output, args.workers, args.queue,
+                               threads=args.threads, shard_size=args.shard_size, retries=args.retries)
+        if failed:
+            print('failed shards: {}'.format(failed))
+            sys.exit(1)
+    elif args.workers > 1:
+        failed = render_sharded(args.script, args.low, args.high, args.repeat, args.output, args.workers,
+                                threads=args.threads, shard_size=args.shard_size, retries=args.retries)
+        if failed:
+            print('failed shards: {}'.format(failed))
+            sys.exit(1)
+    else:
+        render(args.script, args.low, args.high, args.repeat, args.output, threads=args.threads)
@@ -0,0 +1,102 @@
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+## python tile_dems.py --dem survey_dsm.tif --tex survey_ortho.tif --output tiff_files/
+## writes <output>/dems/<name>.tif, <output>/texs/<name>.tif (same names, so DEMRender pairs them) and
+## <output>/tiles.jsonl with the georeferenced bounds of every tile
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--dem', type=str, required=True, help='large source dem (GeoTIFF)')
+parser.add_argument('--tex', type=str, required=True, help='texture covering the dem (GeoTIFF, any resolution)')
+parser.add_argument('--output', default='tiff_files/', type=str, help='root with the dems/ and texs/ folders')
+parser.add_argument('--tile_size', default=1024, type=int, help='tile width and height in dem pixels')
+parser.add_argument('--overlap', default=128, type=int, help='dem pixels shared by neighbouring tiles')
+parser.add_argument('--max_nodata', default=0.0, type=float, help='skip tiles with a larger fraction of nodata')
+parser.add_argument('--name', default='', type=str, help='tile name prefix (default: dem file name)')
+parser.add_argument('--include', default=os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'), type=str,
+                    help='directory to include in python path')
+
+INDEX = 'tiles.jsonl'
+
+
+def tile_starts(size, tile_size, overlap):
+    """ first pixel of every tile along an axis, spread evenly so tiles overlap by at least overlap pixels """
+    step = tile_size - overlap
+    if step <= 0:
+        raise RuntimeError('overlap has to be smaller than the tile size')
+    if size <= tile_size:
+        return [0]
+    n_tiles = -(-(size - tile_size) // step) + 1
+    return [int(round(i * (size - tile_size) / float(n_tiles - 1))) for i in range(n_tiles)]
+
+
+def tile(dem, tex, output, tile_size, overlap, max_nodata=0.0, name=''):
+    """ cuts a dem / texture pair (GeoTiffs) into tiles, returns the index records of the written tiles """
+    from data_creation.GeoTiff import write_geotiff
+
+    name = name or os.path.basename(dem.path).split('.')[0]
+    for folder in ['dems', 'texs']:
+        if not os.path.exists(os.path.join(output, folder)):
+            os.makedirs(os.path.join(output, folder))
+    ## texture pixels per dem pixel
+    scale_x = dem.pixel_size[0] / tex.pixel_size[0]
+    scale_y = dem.pixel_size[1] / tex.pixel_size[1]
+
+    records = []
+    for row in tile_starts(dem.height, tile_size, overlap):
+        for col in tile_starts(dem.width, tile_size, overlap):
+            heights = dem.window(row, col, tile_size, tile_size)
+            if dem.nodata is not None:
+                nodata = float(np.mean(heights == dem.nodata))
+                if nodata > max_nodata:
+                    continue
+            else:
+                nodata = 0.0
+            x = dem.origin[0] + col * dem.pixel_size[0]
+            y = dem.origin[1] - row * dem.pixel_size[1]
+            tex_col = int(round((x - tex.origin[0]) / tex.pixel_size[0]))
+            tex_row = int(round((tex.origin[1] - y) / tex.pixel_size[1]))
+            texture = tex.window(tex_row, tex_col, int(round(tile_size * scale_y)), int(round(tile_size * scale_x)))
+
+            tile_name = '{}_r{:06d}_c{:06d}.tif'.format(name, row, col)
+            write_geotiff(os.path.join(output, 'dems', tile_name), heights, (x, y), dem.pixel_size,
+                          nodata=dem.nodata, like=dem)
+            write_geotiff(os.path.join(output, 'texs', tile_name), texture,
+                          (tex.origin[0] + tex_col * tex.pixel_size[0], tex.origin[1] - tex_row * tex.pixel_size[1]),
+                          tex.pixel_size, nodata=tex.nodata, like=tex)
+            records.append({'name': tile_name, 'dem': dem.path, 'tex': tex.path, 'row': row, 'col': col,
+                            'size': tile_size, 'pixel_size': list(dem.pixel_size),
+                            'bounds': [x, y - tile_size * dem.pixel_size[1], x + tile_size * dem.pixel_size[0], y],
+                            'nodata': nodata})
+    return records
+
+
+def load_index(output):
+    """ {tile name: record} of the tiles written to output """
+    records = {}
+    with open(os.path.join(output, INDEX)) as f:
+        for line in f:
+            record = json.loads(line)
+            records[record['name']] = record
+    return records
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    sys.path.append(args.include)
+    from data_creation.GeoTiff import GeoTiff
+
+    dem, tex = GeoTiff(args.dem), GeoTiff(args.tex)
+    records = tile(dem, tex, args.output, args.tile_size, args.overlap, args.max_nodata, args.name)
+    ## tiles of other sources stay in the index, re-tiled ones are replaced
+    index_path = os.path.join(args.output, INDEX)
+    index = load_index(args.output) if os.path.exists(index_path) else {}
+    index.update((record['name'], record) for record in records)
+    with open(index_path + '.tmp', 'w') as f:
+        for name in sorted(index):
+            f.write(json.dumps(index[name]) + '\n')
+    os.replace(index_path + '.tmp', index_path)
+    print('wrote {} tiles of {} to {}'.format(len(records), os.path.basename(args.dem), args.output))
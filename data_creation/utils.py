@@ -1,3 +1,7 @@
+import os, struct, zlib
+import numpy as np
+
+
 ## if obj.attr is a string of the form '[0,0,0]',
 ## converts it to a list ([0,0,0])
 ## (modifies the object)
@@ -35,3 +39,56 @@ render_parameters = {
     'bunny':        {'scale_low': 4.0, 'scale_high': 6.0, 'pos_low': [0, 0,-2], 'pos_high': [0, 0,-2], 'theta_low': [0,   0,-65], 'theta_high': [0,    0,  65]},
     'teapot':       {'scale_low': 5.0, 'scale_high': 7.5, 'pos_low': [0, 0,-2], 'pos_high': [0, 0,-2], 'theta_low': [0,   0,-65], 'theta_high': [0,    0,  65]}
 }
+
+
+## parse render profiles given as 'mode=engine,samples,max_bounces,resolution_percentage'
+## (e.g. 'mask=BLENDER_RENDER,1,0,50'), trailing fields may be left out
+def parse_profiles(items):
+    profiles = {}
+    for item in items or []:
+        mode, values = item.split('=')
+        profile = {}
+        for key, value, cast in zip(['engine', 'samples', 'max_bounces', 'resolution'], values.split(','),
+                                    [str, int, int, int]):
+            if value != '':
+                profile[key] = cast(value)
+        profiles[mode] = profile
+    return profiles
+
+
+## encode a float [0, 1] (or uint8) image of shape (h, w) or (h, w, 3 / 4) as png bytes
+## (numpy only, so it works outside of blender and off blender's main thread)
+## the dem / texture pairs of DEMRender and NumpyRender (the same index in both lists),
+## at most max_load of them when max_load > 0
+def dem_paths(dem_root_path, tex_root_path, max_load=-1):
+    dems = os.listdir(dem_root_path)
+    texs = os.listdir(tex_root_path)
+    if max_load > 0:
+        dems, texs = dems[:max_load], texs[:max_load]
+    return sorted([os.path.join(dem_root_path, dem_path) for dem_path in dems]), \
+        sorted([os.path.join(tex_root_path, tex_path) for tex_path in texs])
+
+
+def encode_png(img, compression=6):
+    img = np.asarray(img)
+    if img.dtype != np.uint8:
+        img = (np.clip(img, 0., 1.) * 255. + 0.5).astype(np.uint8)
+    if img.ndim == 2:
+        img = img[:, :, np.newaxis]
+    height, width, channels = img.shape
+    color_type = {1: 0, 2: 4, 3: 2, 4: 6}[channels]
+    ## every scanline is prefixed with filter type 0 (none)
+    raw = np.zeros((height, width * channels + 1), dtype=np.uint8)
+    raw[:, 1:] = img.reshape(height, width * channels)
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    header = struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + \
+        chunk(b'IDAT', zlib.compress(raw.tobytes(), compression)) + chunk(b'IEND', b'')
+
+
+def write_png(path, img, compression=6):
+    with open(path, 'wb') as f:
+        f.write(encode_png(img, compression=compression))